@@ -1,12 +1,20 @@
 import os
-import requests
+import json
+import asyncio
+import aiohttp
 import base64
 import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from llama_cpp import Llama
 from loguru import logger
-from groq import Groq
+from groq import AsyncGroq
 from settings import load_settings
-from utils import start_app, load_config
+from utils import BackendLifecycle, load_config
+from cache import TTLCache, make_key, normalize_text
+from vramScheduler import VramScheduler
+from contextlib import nullcontext
 
 settings = load_settings("./src/settings/user_settings.json")
 config = load_config("config.json")
@@ -14,11 +22,46 @@ config = load_config("config.json")
 class ModelClientManager():
     def __init__(self):
         self.clients = {}
-        self.vram_usage = {}
         self.groq_client = GroqClient(api_key=os.getenv('GROQ_API_KEY'))
-        self.ollama_client = OllamaClient(api_url=os.getenv('OLLAMA_API_URL'), app_path=os.getenv('OLLAMA_APP_PATH'))
-        self.stable_diffusion_webUI_client = StableDiffusionWebUIClient(api_url=os.getenv('SD_WebUI_API_URL'))
-        self.max_vram = config["max_vram_model_usage_GB"]
+        self.ollama_client = OllamaClient(api_url=os.getenv('OLLAMA_API_URL'), app_path=os.getenv('OLLAMA_APP_PATH'), http_settings=get_http_settings("ollama"))
+        self.stable_diffusion_webUI_client = StableDiffusionWebUIClient(api_url=os.getenv('SD_WebUI_API_URL'), http_settings=get_http_settings("stable-diffusion-webui"))
+        self.vram_scheduler = VramScheduler(config["max_vram_model_usage_GB"], self.unload_model)
+        self.local_models = {} # model key -> model settings of local models the scheduler has seen
+        # llama.cpp generation is blocking, so it runs on its own thread pool instead of the event loop
+        llama_cpp_workers = config.get("worker_pool", {}).get("backend_concurrency", {}).get("llama_cpp", 1)
+        self.llama_cpp_executor = ThreadPoolExecutor(max_workers=llama_cpp_workers, thread_name_prefix="llama_cpp")
+        llama_cpp_config = config.get("llama_cpp", {})
+        self.llama_cpp_pool = LlamaCppModelPool(
+            executor=self.llama_cpp_executor,
+            memory_budget_gb=llama_cpp_config.get("memory_budget_gb", 16),
+            idle_unload_seconds=llama_cpp_config.get("idle_unload_seconds", 900),
+            load_options=llama_cpp_config.get("load_options", {"use_mmap": True, "use_mlock": False})
+        )
+
+        # Memoization of the image intent check and the image prompt rewrite
+        memoization_config = config.get("memoization", {})
+        persist_folder = memoization_config.get("persist_folder")
+        self.image_intent_cache = TTLCache(
+            "image intent",
+            max_entries=memoization_config.get("max_entries", 1024),
+            ttl_seconds=memoization_config.get("ttl_seconds", 86400),
+            persist_path=os.path.join(persist_folder, "image_intent.json") if persist_folder else None
+        )
+        self.image_prompt_cache = TTLCache(
+            "image prompt",
+            max_entries=memoization_config.get("max_entries", 1024),
+            ttl_seconds=memoization_config.get("ttl_seconds", 86400),
+            persist_path=os.path.join(persist_folder, "image_prompt.json") if persist_folder else None
+        )
+
+        # Opt-in cache for low temperature responses, enabled per model with "response_cache" in user_settings.json
+        response_cache_config = config.get("response_cache", {})
+        self.response_cache_max_temperature = response_cache_config.get("max_temperature", 0.3)
+        self.response_cache = TTLCache(
+            "response",
+            max_entries=response_cache_config.get("max_entries", 512),
+            ttl_seconds=response_cache_config.get("ttl_seconds", 3600)
+        )
 
     def get_client(self, model_settings):
         if model_settings['api_type'] == "external_and_library":
@@ -26,26 +69,15 @@ class ModelClientManager():
                 return self.groq_client
             
         elif model_settings['api_type'] == "local":
-            required_vram = model_settings.get("vram_usage_gb", 0)
-
             if model_settings['api'] == "ollama":
-                if self.check_vram_availability(required_vram):
-                    self.vram_usage[model_settings['model_name']] = required_vram
-                    return self.ollama_client
-                else:
-                    self.unload_unused_models()
-                    if self.check_vram_availability(required_vram):
-                        self.vram_usage[model_settings['model_name']] = required_vram
-                        return self.ollama_client
-                    else:
-                        raise MemoryError(f"Insufficient VRAM to load {model_settings['model_name']}")
-                    
+                return self.ollama_client
+
             elif model_settings['api'] == "llama_cpp":
-                llama_cpp_client = LlamaCppClient(
+                return self.llama_cpp_pool.get_client(
                     model_path=model_settings['model_path'],
-                    chat_format=model_settings['chat_format']
+                    chat_format=model_settings['chat_format'],
+                    n_ctx=model_settings.get('context_tokens', 0)
                 )
-                return llama_cpp_client
             
             elif model_settings['api'] == "stable-diffusion-webui":
                 return self.stable_diffusion_webUI_client
@@ -53,13 +85,21 @@ class ModelClientManager():
         else:
             raise ValueError(f"Unsupported API type {model_settings['api_type']}")
         
-    def ask_if_generate_image(self, user_message, model_settings):
+    async def ask_if_generate_image(self, user_message, model_settings):
+        """Returns the LLM's answer and whether it came from the cache."""
+        cache_key = make_key("image_intent", model_settings["api"], model_settings["model_name"], normalize_text(user_message))
+        cached_response = self.image_intent_cache.get(cache_key)
+        if cached_response is not None:
+            logger.debug(f"Image intent cache hit: {self.image_intent_cache.stats()}")
+            return cached_response, True
+
+        start_time = time.monotonic()
         messages = [
             {"role": "system", "content": "you are a helpful assistant. You only answer with 'yes' or 'no'."},
             {"role": "user", "content": f"Does the User who wrote this message want you to create, generate or paint something? Answer with 'Yes' or 'No'. Here is the Users's message: {user_message}"}
         ]
 
-        response = self.make_llm_call(
+        response = await self.make_llm_call(
             messages=messages,
             model_settings=model_settings,
             temperature=0.4,
@@ -68,9 +108,10 @@ class ModelClientManager():
             stream=False
         )
 
-        return response.strip()
+        self.image_intent_cache.set(cache_key, response.strip(), time.monotonic() - start_time)
+        return response.strip(), False
     
-    def preprocess_image_prompt(self, conversation_log, model_settings):
+    async def preprocess_image_prompt(self, conversation_log, model_settings):
         messages = [{"role": msg["role"], "content": msg["content"]} for msg in conversation_log["messages"]]
         system_prompt = "The following is a conversation between an assistant and a user. The user has the intent to generate an image. Rewrite the user's prompt to improve the image prompt quality. These are the rules on how an image prompt should look like: 1. 'if you simply prompt something very basic like 'Cat with a Hat' you'll indeed get that image, but often with a boring, monotonous background. So, don't just prompt your subject but also your background, like 'Cat with a hat in the forest.', 2. brief descriptions are reccomended. Here are some examples: 1. : ('(Movie poster), (Text 'Paws'), featuring a giant mischievous cat looming over a beachside town, style cartoonish, mood whimsical and playful, colors bright and eye-catching, setting sunny beach day.') or 2. : ('A woman with short hair is touching a metal fence and looking away thoughtfully, with the light casting shadows on her face, highlighting her serene expression.') or 3. : ('a miniature house in half a coconut shell, 2 floor, miniature fourniture, intricate , macro lens, by artgerm, wlop)."
         
@@ -87,7 +128,15 @@ class ModelClientManager():
                 msg["content"] = f"Please generate a prompt for the image model API out of this message: {msg['content']}. Only output the prompt and nothing else"
                 break
 
-        response = self.make_llm_call(
+        # Keyed on everything the LLM sees, a request like "draw it again in blue" depends on the earlier conversation
+        cache_key = make_key("image_prompt", model_settings["api"], model_settings["model_name"], messages)
+        cached_prompt = self.image_prompt_cache.get(cache_key)
+        if cached_prompt is not None:
+            logger.debug(f"Image prompt cache hit: {self.image_prompt_cache.stats()}")
+            return cached_prompt
+
+        start_time = time.monotonic()
+        response = await self.make_llm_call(
             messages=messages,
             model_settings=model_settings,
             temperature=0.5,
@@ -96,69 +145,137 @@ class ModelClientManager():
             stream=False
         )
 
+        self.image_prompt_cache.set(cache_key, response.strip(), time.monotonic() - start_time)
         return response.strip()
     
-    async def make_img_gen_call(self, prompt, model_settings):
-        client = self.get_client(model_settings)
-        image_data = await client.generate_image(prompt, model_settings)
-        return image_data
-
-
-    def make_llm_call(self, messages, model_settings, temperature, max_tokens, top_p, stream):
-        client = self.get_client(model_settings)
-        response = client.chat_completions(messages=messages, model=model_settings["model_name"], temperature=temperature, max_tokens=max_tokens, top_p=top_p, stream=stream)
+    async def make_img_gen_call(self, prompt, model_settings, on_progress=None, progress_interval=2.0, variation_of_seed=None, variation_strength=0.35):
+        """Returns the generated images and the seed of the first one."""
+        async with self.vram_reservation(model_settings):
+            client = self.get_client(model_settings)
+            images, seed = await client.generate_image(prompt, model_settings, on_progress, progress_interval, variation_of_seed, variation_strength)
+        return images, seed
+
+
+    def response_cache_key(self, messages, model_settings, temperature, max_tokens, top_p):
+        """Cache key for a deterministic enough request, or None if the response should not be cached."""
+        if not model_settings.get("response_cache", False) or temperature > self.response_cache_max_temperature:
+            return None
+        return make_key("response", model_settings["api"], model_settings["model_name"], messages, temperature, max_tokens, top_p)
+
+    async def make_llm_call(self, messages, model_settings, temperature, max_tokens, top_p, stream, use_cache=True):
+        cache_key = self.response_cache_key(messages, model_settings, temperature, max_tokens, top_p) if use_cache else None
+        if cache_key is not None:
+            cached_response = self.response_cache.get(cache_key)
+            if cached_response is not None:
+                logger.debug(f"Response cache hit: {self.response_cache.stats()}")
+                return cached_response
+
+        start_time = time.monotonic()
+        # The client is looked up once the VRAM is reserved, so a pooled llama.cpp model can not be unloaded in between
+        async with self.vram_reservation(model_settings):
+            client = self.get_client(model_settings)
+            response = await client.chat_completions(messages=messages, model=model_settings["model_name"], temperature=temperature, max_tokens=max_tokens, top_p=top_p, stream=stream, context_tokens=model_settings.get("context_tokens"))
+        if cache_key is not None:
+            self.response_cache.set(cache_key, response, time.monotonic() - start_time)
         return response
 
-    def check_vram_availability(self, required_vram):
-        current_usage = sum(self.vram_usage.values())
-        return current_usage + required_vram <= self.max_vram
-
-    def update_vram_usage(self, bot, model_name, required_vram):
-        if self.check_vram_availability(required_vram):
-            self.unload_unused_models(bot)
-            if self.check_vram_availability(required_vram):
-                self.vram_usage[model_name] = required_vram
-                return True
-            else:
-                return False
-        else:
-            return False
-
-    def unload_model(self, model_name):
-        """Unload the specified model by name."""
-        if model_name in self.vram_usage:
-            del self.vram_usage[model_name]
-
-            if model_name in [key for key, value in settings['model_text']['choices'].items() if value['api'] == 'ollama']:
-                self.ollama_client.unload_model(model_name)
+    async def stream_llm_call(self, messages, model_settings, temperature, max_tokens, top_p, use_cache=True):
+        """Yield the response of the model token by token. A cached response is yielded at once."""
+        cache_key = self.response_cache_key(messages, model_settings, temperature, max_tokens, top_p) if use_cache else None
+        if cache_key is not None:
+            cached_response = self.response_cache.get(cache_key)
+            if cached_response is not None:
+                logger.debug(f"Response cache hit: {self.response_cache.stats()}")
+                yield cached_response
+                return
+
+        start_time = time.monotonic()
+        tokens = []
+        async with self.vram_reservation(model_settings):
+            client = self.get_client(model_settings)
+            async for token in client.stream_chat_completions(messages=messages, model=model_settings["model_name"], temperature=temperature, max_tokens=max_tokens, top_p=top_p, context_tokens=model_settings.get("context_tokens")):
+                tokens.append(token)
+                yield token
+        if cache_key is not None:
+            self.response_cache.set(cache_key, "".join(tokens), time.monotonic() - start_time)
+
+    @staticmethod
+    def model_key(model_settings):
+        return f"{model_settings['api']}/{model_settings['model_name']}"
 
-            logger.info(f"Unloaded model {model_name} to free up VRAM.")
-
-    def unload_unused_models(self, bot):
-        active_models = self.get_active_model_names(bot)
-        for model in list(self.vram_usage):
-            if model not in active_models:
-                self.unload_model(model)
+    def check_vram_availability(self, required_vram):
+        return self.vram_scheduler.can_fit(required_vram)
+
+    def vram_reservation(self, model_settings):
+        """Hold the VRAM of a local model for the duration of a request, evicting idle models if necessary."""
+        if model_settings['api_type'] != "local" or not model_settings.get("vram_usage_gb"):
+            return nullcontext()
+        model_key = self.model_key(model_settings)
+        self.local_models[model_key] = model_settings
+        return self.vram_scheduler.use(model_key, model_settings["vram_usage_gb"])
+
+    async def unload_model(self, model_key):
+        """Unload a local model from its backend, called by the VRAM scheduler."""
+        model_settings = self.local_models[model_key]
+        if model_settings['api'] == "ollama":
+            await self.ollama_client.unload_model(model_settings['model_name'])
+        elif model_settings['api'] == "llama_cpp":
+            self.llama_cpp_pool.unload_model_path(model_settings['model_path'])
+        elif model_settings['api'] == "stable-diffusion-webui":
+            await self.stable_diffusion_webUI_client.unload_checkpoint()
+
+    async def close(self):
+        """Unload the idle local models, persist the memoization caches, close the pooled HTTP sessions and the llama.cpp thread pool."""
+        logger.info(f"VRAM scheduler: {self.vram_scheduler.state()}")
+        await self.vram_scheduler.unload_all()
+        for cache in (self.image_intent_cache, self.image_prompt_cache, self.response_cache):
+            logger.info(f"{cache.name} cache: {cache.stats()}")
+            cache.save()
+        await self.ollama_client.close()
+        await self.stable_diffusion_webUI_client.close()
+        self.llama_cpp_pool.unload_all()
+        self.llama_cpp_executor.shutdown(wait=False)
+
+def get_http_settings(backend):
+    """HTTP pool settings from config.json, with optional per-backend overrides."""
+    http_config = dict(config.get("http", {}))
+    backend_overrides = http_config.pop("backends", {})
+    http_config.update(backend_overrides.get(backend, {}))
+    return http_config
+
+class PooledHttpClient():
+    """Base class for HTTP backends that keeps one pooled keep-alive session instead of a new connection per request."""
+    def __init__(self, http_settings=None):
+        http_settings = http_settings or {}
+        self.pool_size = http_settings.get("pool_size", 10)
+        self.keepalive_timeout = http_settings.get("keepalive_timeout_seconds", 60)
+        self.timeout = aiohttp.ClientTimeout(
+            total=None,
+            connect=http_settings.get("connect_timeout_seconds", 5),
+            sock_read=http_settings.get("read_timeout_seconds", 300)
+        )
+        self.session = None
 
-    def get_active_model_names(self, bot):
-        """Collect all active models used in conversations."""
-        active_models = set()
+    def get_session(self):
+        # Created lazily, the session has to be bound to the running event loop
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=self.keepalive_timeout)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self.session
 
-        for conversation in bot.queue.conversation_logs.values():
-            active_models.add(conversation["model_text"])
-            active_models.add(conversation["model_img"])
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
 
-        return active_models
-    
 
 ## Text Model Clients
 
 class GroqClient():
     def __init__(self, api_key):
-        self.client = Groq(api_key=api_key)
+        self.client = AsyncGroq(api_key=api_key)
 
-    def chat_completions(self, messages, model, temperature, max_tokens, top_p, stream):
-        response = self.client.chat.completions.create(
+    async def chat_completions(self, messages, model, temperature, max_tokens, top_p, stream, context_tokens=None):
+        response = await self.client.chat.completions.create(
             messages=messages,
             model=model,
             temperature=temperature,
@@ -168,94 +285,372 @@ class GroqClient():
         )
         return response.choices[0].message.content
 
-class OllamaClient():
-    def __init__(self, api_url, app_path):
+    async def stream_chat_completions(self, messages, model, temperature, max_tokens, top_p, context_tokens=None):
+        stream = await self.client.chat.completions.create(
+            messages=messages,
+            model=model,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            top_p=top_p,
+            stream=True
+        )
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            # Closes the connection if the request was cancelled mid-stream
+            await stream.close()
+
+class OllamaClient(PooledHttpClient):
+    def __init__(self, api_url, app_path, http_settings=None):
+        super().__init__(http_settings)
         self.api_url = api_url
         self.app_path = app_path
         self.app_name = "ollama.exe"
+        lifecycle_config = config.get("backend_lifecycle", {})
+        self.lifecycle = BackendLifecycle(
+            probe_url=f"{api_url}/version",
+            app_path=app_path,
+            app_name=self.app_name,
+            ready_ttl=lifecycle_config.get("ready_ttl_seconds", 30),
+            probe_attempts=lifecycle_config.get("probe_attempts", 8),
+            initial_backoff=lifecycle_config.get("initial_backoff_seconds", 0.25),
+            max_backoff=lifecycle_config.get("max_backoff_seconds", 4)
+        )
 
-    def chat_completions(self, messages, model, temperature, max_tokens, top_p, stream):
-        start_app(self.app_path, self.app_name)
-        payload = {
+    def chat_payload(self, messages, model, temperature, max_tokens, top_p, stream, context_tokens=None):
+        return {
             "model": model,
             "messages": messages,
             "stream": stream,
             "options": {
                 "temperature": temperature,
-                "num_ctx": max_tokens,
+                "num_ctx": context_tokens or max_tokens,
+                "num_predict": max_tokens,
                 "top_p": top_p
             },
             "keep_alive": '10m'
         }
-        response = requests.post(self.api_url + "/chat", json=payload)
-        if response.status_code == 200:
-            return response.json()['message']['content']
-        elif response.status_code == 404:
-            self.pull_model(model)
-            time.sleep(10)
-            return self.chat_completions(messages, model, temperature, max_tokens, top_p, stream)
-        else:
-            raise Exception(f"API call failed with status code {response.status_code}: {response.text}")
 
-    def pull_model(self, model_name):
-        """Pulls a model from the Ollama library"""
+    async def post(self, path, **kwargs):
+        """POST to the Ollama API once it is ready. A refused connection invalidates the cached readiness."""
+        session = self.get_session()
+        await self.lifecycle.ensure_ready(session)
+        try:
+            response = await session.post(self.api_url + path, **kwargs)
+        except aiohttp.ClientConnectionError:
+            self.lifecycle.mark_unready()
+            raise
+        self.lifecycle.mark_ready()
+        return response
+
+    async def chat_completions(self, messages, model, temperature, max_tokens, top_p, stream, context_tokens=None):
+        payload = self.chat_payload(messages, model, temperature, max_tokens, top_p, False, context_tokens)
+        # A missing model is pulled and the request retried once
+        for attempt in range(2):
+            async with await self.post("/chat", json=payload) as response:
+                if response.status == 200:
+                    return (await response.json())['message']['content']
+                elif response.status != 404 or attempt:
+                    raise Exception(f"API call failed with status code {response.status}: {await response.text()}")
+            await self.ensure_pulled(model)
+
+    async def stream_chat_completions(self, messages, model, temperature, max_tokens, top_p, context_tokens=None):
+        payload = self.chat_payload(messages, model, temperature, max_tokens, top_p, True, context_tokens)
+        for attempt in range(2):
+            async with await self.post("/chat", json=payload) as response:
+                if response.status == 200:
+                    # Ollama streams one JSON object per line
+                    try:
+                        async for line in response.content:
+                            if not line.strip():
+                                continue
+                            chunk = json.loads(line)
+                            if chunk.get('message', {}).get('content'):
+                                yield chunk['message']['content']
+                            if chunk.get('done'):
+                                return
+                    except (asyncio.CancelledError, GeneratorExit):
+                        # Closing the connection makes Ollama abort the generation
+                        response.close()
+                        raise
+                    return
+                elif response.status != 404 or attempt:
+                    raise Exception(f"API call failed with status code {response.status}: {await response.text()}")
+            await self.ensure_pulled(model)
+
+    async def pull_model(self, model_name):
+        """Pulls a model from the Ollama library, returns whether it succeeded"""
         logger.info(f"Pulling model '{model_name}' from Ollama library.")
-        pull_response = requests.post(self.api_url + "/pull", json={"name": model_name})
-        if pull_response.status_code == 200:
-            logger.info(f"Model '{model_name}' pulled successfully.")
-        else:
-            logger.error(f"Failed to pull model '{model_name}': {pull_response.text}")
+        # Pulling a model can take much longer than the read timeout of a regular request
+        async with await self.post("/pull", json={"name": model_name, "stream": False}, timeout=aiohttp.ClientTimeout(total=None, connect=self.timeout.connect)) as pull_response:
+            if pull_response.status == 200:
+                logger.info(f"Model '{model_name}' pulled successfully.")
+                return True
+            logger.error(f"Failed to pull model '{model_name}': {await pull_response.text()}")
+            return False
+
+    async def ensure_pulled(self, model_name):
+        if not await self.pull_model(model_name):
+            raise Exception(f"Model '{model_name}' was not found and could not be pulled from the Ollama library.")
 
-    def unload_model(self, model):
+    async def unload_model(self, model):
         """Unload a specific Ollama model by sending the appropriate API request."""
         payload = {
             "model": model,
             "keep_alive": '0'
         }
 
-        response = requests.post(self.api_url + "/chat", json=payload)
-        time.sleep(5)
+        async with await self.post("/chat", json=payload) as response:
+            await response.read()
 
 class LlamaCppClient():
-    def __init__(self, model_path, chat_format):
-        self.client = Llama(model_path=model_path, chat_format=chat_format)
-
-    def chat_completions(self, messages, model, temperature, max_tokens, top_p, stream):
-        response = self.client.create_chat_completion(
+    def __init__(self, model_path, chat_format, n_ctx=0, executor=None, load_options=None):
+        self.model_path = model_path
+        self.chat_format = chat_format
+        self.n_ctx = n_ctx
+        self.executor = executor
+        self.load_options = load_options or {}
+        self.client = None
+        self.load_lock = threading.Lock()
+        self.in_flight = 0 # requests using the model, it is not unloaded while this is above zero
+        self.last_used = time.monotonic()
+
+    def load(self):
+        # Runs on the executor thread, loading a GGUF file takes seconds
+        with self.load_lock:
+            if self.client is None:
+                logger.info(f"Loading llama.cpp model {self.model_path}")
+                self.client = Llama(model_path=self.model_path, chat_format=self.chat_format, n_ctx=self.n_ctx, **self.load_options)
+        return self.client
+
+    def unload(self):
+        with self.load_lock:
+            if self.client is not None:
+                logger.info(f"Unloading llama.cpp model {self.model_path}")
+                if hasattr(self.client, "close"):
+                    self.client.close()
+                self.client = None
+
+    def begin_request(self):
+        self.in_flight += 1
+
+    def end_request(self):
+        self.in_flight -= 1
+        self.last_used = time.monotonic()
+
+    def _create_chat_completion(self, messages, temperature, max_tokens, top_p, stream):
+        return self.load().create_chat_completion(
             messages=messages,
             temperature=temperature,
             max_tokens=max_tokens,
             top_p=top_p,
             stream=stream
         )
+
+    async def chat_completions(self, messages, model, temperature, max_tokens, top_p, stream, context_tokens=None):
+        loop = asyncio.get_running_loop()
+        self.begin_request()
+        completion = loop.run_in_executor(self.executor, self._create_chat_completion, messages, temperature, max_tokens, top_p, stream)
+        try:
+            # Shielded so a cancellation leaves the future running until the thread is done
+            response = await asyncio.shield(completion)
+        finally:
+            # A cancelled call can not stop the thread, the model must not be unloaded while it still runs
+            await asyncio.wait({completion})
+            self.end_request()
         return response['choices'][0]['message']['content']
 
+    async def stream_chat_completions(self, messages, model, temperature, max_tokens, top_p, context_tokens=None):
+        loop = asyncio.get_running_loop()
+        tokens = asyncio.Queue()
+        end_of_stream = object()
+
+        stop = threading.Event()
+
+        def produce():
+            # Iterate the blocking llama.cpp stream on the executor thread and hand tokens to the event loop
+            try:
+                for chunk in self._create_chat_completion(messages, temperature, max_tokens, top_p, True):
+                    if stop.is_set():
+                        break # the request was cancelled, stop generating tokens
+                    content = chunk['choices'][0]['delta'].get('content')
+                    if content:
+                        loop.call_soon_threadsafe(tokens.put_nowait, content)
+            except Exception as e:
+                loop.call_soon_threadsafe(tokens.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(tokens.put_nowait, end_of_stream)
+
+        self.begin_request()
+        producer = loop.run_in_executor(self.executor, produce)
+        try:
+            while True:
+                token = await tokens.get()
+                if token is end_of_stream:
+                    break
+                if isinstance(token, Exception):
+                    raise token
+                yield token
+        finally:
+            stop.set()
+            # The model must not be unloaded while the thread still uses it
+            await asyncio.wait({producer})
+            self.end_request()
+
+
+class LlamaCppModelPool():
+    """
+    Keeps LlamaCppClient instances, and the models they loaded, alive between requests, keyed by model path, chat
+    format and context size. Models that have not been used for idle_unload_seconds are unloaded, and least recently
+    used idle models are unloaded when loading another one would exceed memory_budget_gb. The size of a model is
+    estimated from its GGUF file, which is memory mapped by default so reloading it is served from the page cache.
+    """
+    def __init__(self, executor, memory_budget_gb=16, idle_unload_seconds=900, load_options=None):
+        self.executor = executor
+        self.memory_budget_gb = memory_budget_gb
+        self.idle_unload_seconds = idle_unload_seconds
+        self.load_options = load_options or {}
+        self.clients = OrderedDict() # (model_path, chat_format, n_ctx) -> LlamaCppClient, least recently used first
+        self.sizes_gb = {} # same keys -> estimated memory of the model
+        self.sweep_task = None # unloads idle models while any are kept
+
+    @staticmethod
+    def model_size_gb(model_path):
+        try:
+            return os.path.getsize(model_path) / 1024 ** 3
+        except OSError:
+            return 0
+
+    def used_gb(self):
+        return sum(self.sizes_gb[key] for key, client in self.clients.items() if client.client is not None)
+
+    def get_client(self, model_path, chat_format, n_ctx=0):
+        self.unload_idle()
+        key = (model_path, chat_format, n_ctx)
+        client = self.clients.get(key)
+        if client is None:
+            size_gb = self.model_size_gb(model_path)
+            self.make_room(size_gb)
+            client = LlamaCppClient(model_path=model_path, chat_format=chat_format, n_ctx=n_ctx, executor=self.executor, load_options=self.load_options)
+            self.clients[key] = client
+            self.sizes_gb[key] = size_gb
+        elif client.client is None:
+            self.make_room(self.sizes_gb[key])
+        self.clients.move_to_end(key)
+        client.last_used = time.monotonic()
+        if self.sweep_task is None or self.sweep_task.done():
+            self.sweep_task = asyncio.create_task(self.sweep_idle())
+        return client
+
+    async def sweep_idle(self):
+        """Unload idle models on time instead of on the next request, until no client is kept anymore."""
+        while self.clients:
+            await asyncio.sleep(min(60, self.idle_unload_seconds))
+            self.unload_idle()
+
+    def make_room(self, size_gb):
+        for key, client in list(self.clients.items()):
+            if self.used_gb() + size_gb <= self.memory_budget_gb:
+                return
+            if client.in_flight == 0:
+                self.remove(key)
+        if self.used_gb() + size_gb > self.memory_budget_gb:
+            logger.warning(f"llama.cpp models exceed the memory budget of {self.memory_budget_gb} GB, the loaded models are in use.")
+
+    def unload_idle(self):
+        now = time.monotonic()
+        for key, client in list(self.clients.items()):
+            if client.in_flight == 0 and now - client.last_used > self.idle_unload_seconds:
+                self.remove(key)
+
+    def remove(self, key):
+        client = self.clients.pop(key)
+        del self.sizes_gb[key]
+        client.unload()
+
+    def unload_model_path(self, model_path):
+        for key, client in list(self.clients.items()):
+            if key[0] == model_path and client.in_flight == 0:
+                self.remove(key)
+
+    def unload_all(self):
+        if self.sweep_task is not None:
+            self.sweep_task.cancel()
+        for key in list(self.clients):
+            self.remove(key)
+
 
 ## Image Model Clients
 
 
-class StableDiffusionWebUIClient():
-    def __init__(self, api_url):
+class StableDiffusionWebUIClient(PooledHttpClient):
+    def __init__(self, api_url, http_settings=None):
+        super().__init__(http_settings)
         self.api_url = api_url
 
-    async def generate_image(self, prompt, model_settings):
+    async def generate_image(self, prompt, model_settings, on_progress=None, progress_interval=2.0, variation_of_seed=None, variation_strength=0.35):
+        """
+        Generate batch_size * n_iter images with one txt2img call and return them with the seed of the first image.
+        With variation_of_seed the images are variations of the image generated with that seed.
+        on_progress(fraction, eta_seconds) is awaited periodically while it runs.
+        """
         payload = {
             "prompt": prompt,
             "steps": model_settings['steps'],
             "cfg_scale": model_settings['cfg_scale'],
             "width": model_settings['width'],
-            "height": model_settings['height']
+            "height": model_settings['height'],
+            "batch_size": model_settings.get('batch_size', 1),
+            "n_iter": model_settings.get('n_iter', 1)
         }
+        if variation_of_seed is not None:
+            payload.update({"seed": variation_of_seed, "subseed": -1, "subseed_strength": variation_strength})
 
+        progress_task = asyncio.create_task(self.poll_progress(on_progress, progress_interval)) if on_progress else None
         try:
-            response = (requests.post(url=f'{self.api_url}/sdapi/v1/txt2img', json=payload)).json()
+            session = self.get_session()
+            async with session.post(url=f'{self.api_url}/sdapi/v1/txt2img', json=payload) as http_response:
+                body = await http_response.read()
 
-            if 'images' in response and response['images']:
-                return base64.b64decode(response['images'][0])
-            else:
+            # The response holds base64 encoded PNGs, parse and decode the multi-MB payload off the event loop
+            response = await asyncio.to_thread(json.loads, body)
+            if not response.get('images'):
                 logger.error("No images found in the response")
-                return None
-            
-        except requests.exceptions.RequestException as e:
+                return [], None
+            images = await asyncio.gather(*(asyncio.to_thread(base64.b64decode, image) for image in response['images']))
+            return list(images), self.first_seed(response)
+
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
             logger.error(f"API call failed: {e}")
-            return None
\ No newline at end of file
+            return [], None
+        finally:
+            if progress_task is not None:
+                # Wait for the task, so no progress update is posted after the image
+                progress_task.cancel()
+                await asyncio.wait({progress_task})
+
+    @staticmethod
+    def first_seed(response):
+        try:
+            return json.loads(response.get('info') or "{}").get('seed')
+        except ValueError:
+            return None
+
+    async def poll_progress(self, on_progress, interval):
+        session = self.get_session()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                async with session.get(url=f'{self.api_url}/sdapi/v1/progress', params={"skip_current_image": "true"}) as http_response:
+                    progress = await http_response.json()
+                if progress.get("progress"):
+                    await on_progress(progress["progress"], progress.get("eta_relative"))
+            except Exception as e:
+                logger.debug(f"Failed to poll image generation progress: {e}")
+
+    async def unload_checkpoint(self):
+        session = self.get_session()
+        async with session.post(url=f'{self.api_url}/sdapi/v1/unload-checkpoint') as http_response:
+            await http_response.read()
\ No newline at end of file
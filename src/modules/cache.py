@@ -0,0 +1,84 @@
+import os
+import re
+import json
+import time
+import hashlib
+from collections import OrderedDict
+from loguru import logger
+
+def normalize_text(text):
+    """Lowercase, collapse whitespace and drop trailing punctuation, so near-identical messages share a cache key."""
+    return re.sub(r"\s+", " ", text.lower()).strip().rstrip(".!?").strip()
+
+def make_key(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+class TTLCache():
+    """
+    Bounded LRU cache whose entries expire after ttl_seconds. Counts hits and misses and the time spent on misses,
+    to estimate how much latency the hits saved. With a persist_path the entries survive restarts.
+    """
+    def __init__(self, name, max_entries=1024, ttl_seconds=3600, persist_path=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.persist_path = persist_path
+        self.entries = OrderedDict() # key -> (expires_at, value), least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.miss_seconds = 0.0
+        if persist_path:
+            self.load()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.time():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, miss_seconds=0.0):
+        self.entries[key] = (time.time() + self.ttl_seconds, value)
+        self.entries.move_to_end(key)
+        self.miss_seconds += miss_seconds
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        average_miss_seconds = self.miss_seconds / self.misses if self.misses else 0.0
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "saved_seconds": self.hits * average_miss_seconds
+        }
+
+    def load(self):
+        if not os.path.exists(self.persist_path):
+            return
+        try:
+            with open(self.persist_path, "r", encoding="utf-8") as f:
+                now = time.time()
+                for key, expires_at, value in json.load(f):
+                    if expires_at > now:
+                        self.entries[key] = (expires_at, value)
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to load {self.name} cache from {self.persist_path}: {e}")
+
+    def save(self):
+        if not self.persist_path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.persist_path) or ".", exist_ok=True)
+            tmp_path = f"{self.persist_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump([[key, expires_at, value] for key, (expires_at, value) in self.entries.items()], f)
+            os.replace(tmp_path, self.persist_path)
+        except OSError as e:
+            logger.error(f"Failed to save {self.name} cache to {self.persist_path}: {e}")
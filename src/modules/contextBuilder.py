@@ -0,0 +1,60 @@
+import re
+import math
+
+message_overhead_tokens = 4 # role and formatting tokens every chat template adds per message
+token_pattern = re.compile(r"\w+|[^\w\s]")
+
+def count_tokens(text):
+    """Approximate the token count of a text, about 1.3 tokens per word or punctuation mark for Llama/Mixtral style tokenizers."""
+    return math.ceil(len(token_pattern.findall(text)) * 1.3)
+
+def message_tokens(message_entry):
+    """Token count of a conversation log entry, cached on the entry until its content changes."""
+    content = message_entry.get("content") or ""
+    cache = message_entry.get("token_cache")
+    if cache is None or cache["chars"] != len(content):
+        cache = {"chars": len(content), "tokens": count_tokens(content) + message_overhead_tokens}
+        message_entry["token_cache"] = cache
+    return cache["tokens"]
+
+def prompt_budget(model_settings, max_tokens, response_reserve_ratio=0.25):
+    """Tokens available for the prompt: the model's context window minus the room reserved for the response."""
+    context_tokens = model_settings.get("context_tokens")
+    if not context_tokens:
+        return None
+    response_reserve = min(max_tokens, int(context_tokens * response_reserve_ratio))
+    return context_tokens - response_reserve
+
+def build_context(conversation_log, budget):
+    """
+    Select the messages to send to the model. Character messages (system prompt and example turns) are always kept,
+    followed by the rolling summary of older messages if there is one. The remaining messages are filled in from the
+    newest to the oldest until the budget is used up. The newest message is always included.
+    Returns the messages and the number of tokens that were trimmed.
+    """
+    entries = conversation_log["messages"]
+    pinned = [entry for entry in entries if entry.get("type") == "character_msg"]
+    history = [entry for entry in entries if entry.get("type") != "character_msg"]
+
+    # Messages covered by the summary are replaced by it
+    summary = conversation_log.get("summary")
+    if summary and summary["content"]:
+        history = history[min(summary["message_count"], max(len(history) - 1, 0)):]
+        pinned = pinned + [{"role": "system", "content": f"Summary of the earlier conversation: {summary['content']}"}]
+
+    if budget is None:
+        kept = history
+    else:
+        remaining = budget - sum(message_tokens(entry) for entry in pinned)
+        kept = []
+        for entry in reversed(history):
+            tokens = message_tokens(entry)
+            if tokens > remaining and kept:
+                break
+            kept.append(entry)
+            remaining -= tokens
+        kept.reverse()
+
+    trimmed_tokens = sum(message_tokens(entry) for entry in history[:len(history) - len(kept)])
+    messages = [{"role": entry["role"], "content": entry["content"]} for entry in pinned + kept]
+    return messages, trimmed_tokens
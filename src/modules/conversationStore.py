@@ -0,0 +1,476 @@
+import asyncio
+import os
+import sys
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from datetime import datetime
+from loguru import logger
+
+
+class ConversationStore():
+    """
+    Base class for write-behind conversation persistence.
+
+    Changes are recorded as snapshot, append, truncate, meta and delete records. Records are buffered in memory
+    and flushed by a background task every flush_interval seconds, or earlier once flush_batch_size records are pending.
+    Backends implement load, list_ids, stored_exists and write_pending.
+    """
+    def __init__(self, flush_interval=2, flush_batch_size=50):
+        self.flush_interval = flush_interval
+        self.flush_batch_size = flush_batch_size
+        self.pending = {} # conversation_id -> list of records not yet written
+        self.writing = {} # conversation_id -> list of records a flush is writing right now
+        self.pending_count = 0
+        self.flush_lock = asyncio.Lock()
+        self.flush_requested = asyncio.Event()
+        self.flush_task = None
+        self.on_flush = None # called after every flush, used by ConversationCache to evict idle conversations
+
+    ## Recording changes
+
+    def record(self, conversation_id, record):
+        if record["op"] in ("snapshot", "delete"):
+            # A snapshot or deletion supersedes everything that is still pending for the conversation
+            self.pending_count -= len(self.pending.get(conversation_id, []))
+            self.pending[conversation_id] = [record]
+            self.pending_count += 1
+        else:
+            self.pending.setdefault(conversation_id, []).append(record)
+            self.pending_count += 1
+
+        if self.pending_count >= self.flush_batch_size:
+            self.flush_requested.set()
+
+    def save(self, conversation_id, conversation_log):
+        """Store the whole conversation log, replacing its journal."""
+        self.record(conversation_id, {"op": "snapshot", "log": json.loads(json.dumps(conversation_log))})
+
+    def append_message(self, conversation_id, message):
+        self.record(conversation_id, {"op": "append", "message": dict(message)})
+
+    def truncate_messages(self, conversation_id, length):
+        """Record that the conversation now only keeps its first `length` messages."""
+        self.record(conversation_id, {"op": "truncate", "length": length})
+
+    def update_meta(self, conversation_id, conversation_log):
+        """Record the non-message fields of the conversation log."""
+        fields = {key: value for key, value in conversation_log.items() if key != "messages"}
+        self.record(conversation_id, {"op": "meta", "fields": json.loads(json.dumps(fields))})
+
+    def delete(self, conversation_id):
+        self.record(conversation_id, {"op": "delete"})
+
+    def is_dirty(self, conversation_id):
+        # Conversations that are being written stay in memory, a load could read them half written
+        return conversation_id in self.pending or conversation_id in self.writing
+
+    def exists(self, conversation_id):
+        for records in (self.pending.get(conversation_id), self.writing.get(conversation_id)):
+            if records:
+                return records[0]["op"] != "delete" or len(records) > 1
+        return self.stored_exists(conversation_id)
+
+    ## Backend interface
+
+    def load(self, conversation_id):
+        """Load a single conversation log, or None if it does not exist."""
+        raise NotImplementedError
+
+    def list_ids(self):
+        raise NotImplementedError
+
+    def stored_exists(self, conversation_id):
+        raise NotImplementedError
+
+    def write_pending(self, pending):
+        """Write the given records, runs on a worker thread."""
+        raise NotImplementedError
+
+    @staticmethod
+    def replay(records):
+        conversation_log = None
+        for record in records:
+            if record["op"] == "snapshot":
+                conversation_log = record["log"]
+            elif conversation_log is None:
+                continue
+            elif record["op"] == "append":
+                conversation_log["messages"].append(record["message"])
+            elif record["op"] == "truncate":
+                del conversation_log["messages"][record["length"]:]
+            elif record["op"] == "meta":
+                conversation_log.update(record["fields"])
+        return conversation_log
+
+    ## Background flushing
+
+    async def flush(self):
+        """Write all pending records, off the event loop."""
+        async with self.flush_lock:
+            if self.pending:
+                self.writing, self.pending, self.pending_count = self.pending, {}, 0
+                self.flush_requested.clear()
+                try:
+                    await asyncio.to_thread(self.write_pending, self.writing)
+                finally:
+                    self.writing = {}
+        if self.on_flush is not None:
+            self.on_flush()
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.flush_requested.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            # Cancelling can not stop the writer thread, so a flush in progress keeps the lock until it is written
+            await asyncio.shield(self.flush())
+
+    def start(self):
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self.run())
+
+    async def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            await asyncio.wait({self.flush_task})
+        await self.flush()
+
+
+class JournalConversationStore(ConversationStore):
+    """
+    Append-only JSONL journals, one per conversation in log_folder. The first record is a snapshot of the whole log,
+    the following records are the changes since. Journals that grow past compact_after_records are rewritten as a
+    single snapshot. Snapshots are written to a temporary file and renamed, so a crash can never leave a half written log behind.
+    """
+    def __init__(self, log_folder, flush_interval=2, flush_batch_size=50, compact_after_records=200):
+        super().__init__(flush_interval, flush_batch_size)
+        self.log_folder = log_folder
+        self.compact_after_records = compact_after_records
+        self.journal_lengths = {} # conversation_id -> number of records in the journal file
+
+    def journal_path(self, conversation_id):
+        return os.path.join(self.log_folder, f"{conversation_id}.jsonl")
+
+    def legacy_path(self, conversation_id):
+        return os.path.join(self.log_folder, f"{conversation_id}.json")
+
+    def stored_exists(self, conversation_id):
+        return os.path.exists(self.journal_path(conversation_id)) or os.path.exists(self.legacy_path(conversation_id))
+
+    def list_ids(self):
+        if not os.path.exists(self.log_folder):
+            return []
+        conversation_ids = set()
+        for filename in os.listdir(self.log_folder):
+            conversation_id, extension = os.path.splitext(filename)
+            if extension in (".jsonl", ".json"):
+                conversation_ids.add(conversation_id)
+        return sorted(conversation_ids)
+
+    ## Loading
+
+    def read_journal(self, path):
+        records = []
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # A torn last line from a crash mid-append, everything before it is intact
+                    logger.warning(f"Skipping corrupt record in {path}")
+        return records
+
+    def load(self, conversation_id):
+        path = self.journal_path(conversation_id)
+        if os.path.exists(path):
+            records = self.read_journal(path)
+            self.journal_lengths[conversation_id] = len(records)
+            return self.replay(records)
+
+        # Logs written before the journal format are migrated on first load
+        legacy_path = self.legacy_path(conversation_id)
+        if os.path.exists(legacy_path):
+            with open(legacy_path, "r", encoding="utf-8") as f:
+                conversation_log = json.load(f)
+            self.write_snapshot(conversation_id, [{"op": "snapshot", "log": conversation_log}])
+            os.remove(legacy_path)
+            logger.info(f"Migrated conversation log {legacy_path} to the journal format")
+            return conversation_log
+        return None
+
+    ## Writing
+
+    def write_snapshot(self, conversation_id, records):
+        """Atomically replace the journal with the given records."""
+        os.makedirs(self.log_folder, exist_ok=True)
+        path = self.journal_path(conversation_id)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self.journal_lengths[conversation_id] = len(records)
+
+    def append_records(self, conversation_id, records):
+        os.makedirs(self.log_folder, exist_ok=True)
+        with open(self.journal_path(conversation_id), "a", encoding="utf-8") as f:
+            f.write("".join(json.dumps(record) + "\n" for record in records))
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal_lengths[conversation_id] = self.journal_lengths.get(conversation_id, 0) + len(records)
+
+    def compact(self, conversation_id):
+        conversation_log = self.replay(self.read_journal(self.journal_path(conversation_id)))
+        if conversation_log is not None:
+            self.write_snapshot(conversation_id, [{"op": "snapshot", "log": conversation_log}])
+
+    def write_pending(self, pending):
+        for conversation_id, records in pending.items():
+            try:
+                if records[0]["op"] == "delete":
+                    for path in (self.journal_path(conversation_id), self.legacy_path(conversation_id)):
+                        if os.path.exists(path):
+                            os.remove(path)
+                    self.journal_lengths.pop(conversation_id, None)
+                elif records[0]["op"] == "snapshot":
+                    self.write_snapshot(conversation_id, records)
+                else:
+                    self.append_records(conversation_id, records)
+
+                if self.journal_lengths.get(conversation_id, 0) > self.compact_after_records:
+                    self.compact(conversation_id)
+            except Exception as e:
+                logger.error(f"Failed to write conversation log for {conversation_id}: {e}")
+
+
+class SQLiteConversationStore(ConversationStore):
+    """Conversation logs in a SQLite database in WAL mode, with one row per conversation and one row per message."""
+    def __init__(self, db_path, flush_interval=2, flush_batch_size=50):
+        super().__init__(flush_interval, flush_batch_size)
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        # Flushes write on a worker thread, the lock serializes them on the write connection
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection_lock = threading.Lock()
+        with self.connection_lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS conversations (
+                    conversation_id TEXT PRIMARY KEY,
+                    meta TEXT NOT NULL,
+                    updated_at TEXT NOT NULL
+                )""")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    conversation_id TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    message TEXT NOT NULL,
+                    PRIMARY KEY (conversation_id, position)
+                )""")
+
+        # Loads and existence checks run on the event loop. In WAL mode readers do not wait for a commit, so they use
+        # their own connection instead of waiting for the flush thread's lock
+        self.read_connection = sqlite3.connect(db_path, check_same_thread=False)
+
+    def stored_exists(self, conversation_id):
+        row = self.read_connection.execute("SELECT 1 FROM conversations WHERE conversation_id = ?", (conversation_id,)).fetchone()
+        return row is not None
+
+    def list_ids(self):
+        rows = self.read_connection.execute("SELECT conversation_id FROM conversations ORDER BY conversation_id").fetchall()
+        return [row[0] for row in rows]
+
+    def load(self, conversation_id):
+        row = self.read_connection.execute("SELECT meta FROM conversations WHERE conversation_id = ?", (conversation_id,)).fetchone()
+        if row is None:
+            return None
+        message_rows = self.read_connection.execute("SELECT message FROM messages WHERE conversation_id = ? ORDER BY position", (conversation_id,)).fetchall()
+        conversation_log = json.loads(row[0])
+        conversation_log["messages"] = [json.loads(message_row[0]) for message_row in message_rows]
+        return conversation_log
+
+    def write_snapshot(self, cursor, conversation_id, conversation_log):
+        meta = {key: value for key, value in conversation_log.items() if key != "messages"}
+        cursor.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+        cursor.execute("INSERT OR REPLACE INTO conversations (conversation_id, meta, updated_at) VALUES (?, ?, ?)", (conversation_id, json.dumps(meta), datetime.now().isoformat()))
+        cursor.executemany("INSERT INTO messages (conversation_id, position, message) VALUES (?, ?, ?)",
+                           [(conversation_id, position, json.dumps(message)) for position, message in enumerate(conversation_log["messages"])])
+
+    def write_records(self, cursor, conversation_id, records):
+        message_count = cursor.execute("SELECT COUNT(*) FROM messages WHERE conversation_id = ?", (conversation_id,)).fetchone()[0]
+        for record in records:
+            if record["op"] == "delete":
+                cursor.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+                cursor.execute("DELETE FROM conversations WHERE conversation_id = ?", (conversation_id,))
+                message_count = 0
+            elif record["op"] == "snapshot":
+                self.write_snapshot(cursor, conversation_id, record["log"])
+                message_count = len(record["log"]["messages"])
+            elif record["op"] == "append":
+                cursor.execute("INSERT OR REPLACE INTO messages (conversation_id, position, message) VALUES (?, ?, ?)", (conversation_id, message_count, json.dumps(record["message"])))
+                message_count += 1
+            elif record["op"] == "truncate":
+                cursor.execute("DELETE FROM messages WHERE conversation_id = ? AND position >= ?", (conversation_id, record["length"]))
+                message_count = min(message_count, record["length"])
+            elif record["op"] == "meta":
+                cursor.execute("UPDATE conversations SET meta = ?, updated_at = ? WHERE conversation_id = ?", (json.dumps(record["fields"]), datetime.now().isoformat(), conversation_id))
+
+    def write_pending(self, pending):
+        with self.connection_lock:
+            for conversation_id, records in pending.items():
+                try:
+                    with self.connection:
+                        self.write_records(self.connection.cursor(), conversation_id, records)
+                except Exception as e:
+                    logger.error(f"Failed to write conversation log for {conversation_id}: {e}")
+
+    async def close(self):
+        await super().close()
+        self.read_connection.close()
+        with self.connection_lock:
+            self.connection.close()
+
+
+class ConversationCache(MutableMapping):
+    """
+    Dict-like view of the conversation logs that loads a conversation from the store on first access.
+    At most max_loaded conversations are kept in memory (least recently used first out), and conversations
+    that were not accessed for idle_seconds are evicted. Conversations with unwritten changes, or for which
+    can_evict returns False, stay in memory. on_load(conversation_id, conversation_log) and on_evict(conversation_id)
+    are called whenever a conversation enters or leaves memory.
+    """
+    def __init__(self, store, max_loaded=200, idle_seconds=1800, can_evict=None, on_load=None, on_evict=None):
+        self.store = store
+        self.max_loaded = max_loaded
+        self.idle_seconds = idle_seconds
+        self.can_evict = can_evict or (lambda conversation_id: True)
+        self.on_load = on_load or (lambda conversation_id, conversation_log: None)
+        self.on_evict = on_evict or (lambda conversation_id: None)
+        self.loaded = OrderedDict() # conversation_id -> conversation log, least recently used first
+        self.last_access = {}
+        self.store.on_flush = self.evict
+
+    def touch(self, conversation_id):
+        self.loaded.move_to_end(conversation_id)
+        self.last_access[conversation_id] = time.monotonic()
+
+    def __getitem__(self, conversation_id):
+        if conversation_id in self.loaded:
+            self.touch(conversation_id)
+            return self.loaded[conversation_id]
+        conversation_log = self.load(conversation_id)
+        if conversation_log is None:
+            raise KeyError(conversation_id)
+        return conversation_log
+
+    def load(self, conversation_id):
+        """Load a conversation from the store into memory, return None if it does not exist."""
+        conversation_log = self.store.load(conversation_id) if self.store.exists(conversation_id) else None
+        if conversation_log is None:
+            return None
+        self.loaded[conversation_id] = conversation_log
+        logger.info(f"Loaded conversation log for {conversation_id}")
+        self.on_load(conversation_id, conversation_log)
+        self.touch(conversation_id)
+        self.evict(keep=conversation_id)
+        return conversation_log
+
+    def ensure_loaded(self, conversation_id):
+        """Make sure the conversation is in memory, and indexed through on_load. Returns False if it does not exist."""
+        return conversation_id in self.loaded or self.load(conversation_id) is not None
+
+    def __setitem__(self, conversation_id, conversation_log):
+        self.loaded[conversation_id] = conversation_log
+        self.on_load(conversation_id, conversation_log)
+        self.touch(conversation_id)
+
+    def __delitem__(self, conversation_id):
+        if conversation_id not in self:
+            raise KeyError(conversation_id)
+        self.loaded.pop(conversation_id, None)
+        self.last_access.pop(conversation_id, None)
+        self.on_evict(conversation_id)
+
+    def __contains__(self, conversation_id):
+        return conversation_id in self.loaded or self.store.exists(conversation_id)
+
+    def __iter__(self):
+        # Iterating visits every stored conversation, which loads them all
+        conversation_ids = list(self.loaded)
+        conversation_ids += [conversation_id for conversation_id in self.store.list_ids() if conversation_id not in self.loaded]
+        return iter(conversation_ids)
+
+    def __len__(self):
+        return len(set(self.loaded) | set(self.store.list_ids()))
+
+    def is_evictable(self, conversation_id):
+        return not self.store.is_dirty(conversation_id) and self.can_evict(conversation_id)
+
+    def evict(self, keep=None):
+        """Evict idle conversations and the least recently used ones over max_loaded, except keep."""
+        now = time.monotonic()
+        for conversation_id in list(self.loaded):
+            if conversation_id == keep:
+                continue
+            over_limit = len(self.loaded) > self.max_loaded
+            idle = now - self.last_access.get(conversation_id, now) > self.idle_seconds
+            if not over_limit and not idle:
+                continue
+            if self.is_evictable(conversation_id):
+                del self.loaded[conversation_id]
+                self.last_access.pop(conversation_id, None)
+                self.on_evict(conversation_id)
+                logger.debug(f"Evicted conversation log for {conversation_id} from memory")
+
+
+def create_conversation_store(store_config, log_folder):
+    """Create the storage backend selected by the conversation_store section of config.json."""
+    backend = store_config.get("backend", "journal")
+    flush_interval = store_config.get("flush_interval_seconds", 2)
+    flush_batch_size = store_config.get("flush_batch_size", 50)
+    if backend == "sqlite":
+        return SQLiteConversationStore(store_config.get("sqlite_path", os.path.join(log_folder, "conversations.db")), flush_interval, flush_batch_size)
+    elif backend == "journal":
+        return JournalConversationStore(log_folder, flush_interval, flush_batch_size, store_config.get("compact_after_records", 200))
+    else:
+        raise ValueError(f"Unsupported conversation store backend {backend}")
+
+
+def migrate_file_logs(log_folder, store):
+    """
+    One-shot import of the .json/.jsonl conversation logs in log_folder into another store.
+    Imported files are renamed to *.migrated so the import does not run twice. Returns the number of imported conversations.
+    """
+    file_store = JournalConversationStore(log_folder)
+    migrated = 0
+    for conversation_id in file_store.list_ids():
+        if store.exists(conversation_id):
+            continue
+        conversation_log = file_store.load(conversation_id)
+        if conversation_log is None:
+            continue
+        store.write_pending({conversation_id: [{"op": "snapshot", "log": conversation_log}]})
+        for path in (file_store.journal_path(conversation_id), file_store.legacy_path(conversation_id)):
+            if os.path.exists(path):
+                os.replace(path, f"{path}.migrated")
+        migrated += 1
+        logger.info(f"Migrated conversation log for {conversation_id}")
+    return migrated
+
+
+if __name__ == "__main__":
+    # python src/modules/conversationStore.py [log_folder] - import the file based logs into the configured store
+    from utils import load_config
+    log_folder = sys.argv[1] if len(sys.argv) > 1 else "./logs/conversations"
+    store = create_conversation_store(load_config("config.json").get("conversation_store", {}), log_folder)
+    logger.info(f"Migrated {migrate_file_logs(log_folder, store)} conversation logs.")
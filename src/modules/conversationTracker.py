@@ -0,0 +1,68 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+
+class ConversationState():
+    def __init__(self):
+        self.pending = 0 # requests queued but not started yet
+        self.in_flight = False # a request is being processed right now
+        self.lock = asyncio.Lock() # serializes changes to the conversation log
+        self.epoch = 0 # incremented by cancel(), requests enqueued in an earlier epoch are dropped
+
+    def is_busy(self):
+        return self.pending > 0 or self.in_flight or self.lock.locked()
+
+
+class ConversationTracker():
+    """
+    Per-conversation request state with O(1) busy checks. A conversation counts as busy while it has queued
+    requests, a request in progress or someone holding its lock. States of idle conversations are dropped.
+    """
+    def __init__(self):
+        self.states = {} # conversation_id -> ConversationState
+
+    def get(self, conversation_id):
+        if conversation_id not in self.states:
+            self.states[conversation_id] = ConversationState()
+        return self.states[conversation_id]
+
+    def cleanup(self, conversation_id):
+        state = self.states.get(conversation_id)
+        if state is not None and not state.is_busy():
+            del self.states[conversation_id]
+
+    def is_busy(self, conversation_id):
+        state = self.states.get(conversation_id)
+        return state is not None and state.is_busy()
+
+    def enqueued(self, conversation_id):
+        self.get(conversation_id).pending += 1
+
+    def started(self, conversation_id):
+        state = self.get(conversation_id)
+        state.pending -= 1
+        state.in_flight = True
+
+    def finished(self, conversation_id):
+        self.get(conversation_id).in_flight = False
+        self.cleanup(conversation_id)
+
+    def cancel(self, conversation_id):
+        self.get(conversation_id).epoch += 1
+
+    def is_cancelled(self, conversation_id, epoch):
+        return self.get(conversation_id).epoch != epoch
+
+    def dropped(self, conversation_id):
+        self.get(conversation_id).pending -= 1
+        self.cleanup(conversation_id)
+
+    @asynccontextmanager
+    async def locked(self, conversation_id):
+        """Hold the conversation's lock while changing its log."""
+        state = self.get(conversation_id)
+        try:
+            async with state.lock:
+                yield state
+        finally:
+            self.cleanup(conversation_id)
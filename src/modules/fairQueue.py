@@ -0,0 +1,143 @@
+import time
+import asyncio
+from contextlib import asynccontextmanager
+
+lanes = ("intent", "private", "public")
+
+
+class Waiter():
+    """A request waiting for a slot. queued is True for requests registered with FairScheduler.enqueued()."""
+    def __init__(self, user_id, lane, model_key=None, queued=False):
+        self.user_id = user_id
+        self.lane = lane
+        self.model_key = model_key
+        self.queued = queued
+        self.enqueued_at = time.monotonic()
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class FairPolicy():
+    """
+    Picks which of several waiting requests is admitted next. Lanes with waiting requests are served in proportion
+    to their weights (smooth weighted round robin), and within a lane the users take turns: the user whose last turn
+    is longest ago goes first, so one user with many requests can not push everyone else back.
+    """
+    def __init__(self, lane_weights=None):
+        self.lane_weights = {lane: 1 for lane in lanes}
+        self.lane_weights.update(lane_weights or {})
+        self.current_weights = {lane: 0 for lane in self.lane_weights}
+        self.last_turns = {} # (lane, user_id) -> number of the user's last turn in the lane, for users that are waiting
+        self.turns = 0
+
+    def pick(self, candidates, waiters=None):
+        """Return the next of candidates, which are in arrival order and a subset of all waiters."""
+        by_lane = {}
+        for waiter in candidates:
+            by_lane.setdefault(waiter.lane, []).append(waiter)
+        lane = self.pick_lane(list(by_lane))
+        # Users without a turn yet go first, and each user's oldest request is served first
+        waiter = min(by_lane[lane], key=lambda candidate: self.last_turns.get((lane, candidate.user_id), 0))
+        self.served(waiter, candidates if waiters is None else waiters)
+        return waiter
+
+    def served(self, waiter, waiters):
+        """Record the turn of waiter. Users without other waiting requests are forgotten and start over as new users."""
+        self.turns += 1
+        waiting_users = {(other.lane, other.user_id) for other in waiters if other is not waiter}
+        self.last_turns = {key: turn for key, turn in self.last_turns.items() if key in waiting_users}
+        self.last_turns[(waiter.lane, waiter.user_id)] = self.turns
+
+    def pick_lane(self, waiting_lanes):
+        for waiting_lane in waiting_lanes:
+            self.current_weights[waiting_lane] += self.lane_weights[waiting_lane]
+        lane = max(waiting_lanes, key=self.current_weights.get)
+        self.current_weights[lane] -= sum(self.lane_weights[waiting_lane] for waiting_lane in waiting_lanes)
+        return lane
+
+
+class FairScheduler():
+    """
+    Admits requests to the worker slots fairly instead of first come, first served.
+
+    Requests wait in priority lanes: short intent checks, private llm-<name> channels and public mentions, and are
+    admitted in the order of a FairPolicy. Queued requests are registered with enqueued() and count towards the queue
+    positions until they are admitted to run, also while they wait for a backend slot.
+    """
+    def __init__(self, capacity, lane_weights=None):
+        self.capacity = capacity
+        self.active = 0
+        self.policy = FairPolicy(lane_weights)
+        self.lane_weights = self.policy.lane_weights
+        self.waiters = [] # Waiter objects in arrival order
+        self.queued = {lane: {} for lane in self.lane_weights} # lane -> user_id -> queued requests that did not start yet
+
+    def has_waiters(self):
+        return bool(self.waiters)
+
+    def enqueued(self, user_id, lane):
+        """Register a queued request and return its estimated position in the queue, 1 means next."""
+        position = self.position(user_id, lane)
+        self.queued[lane][user_id] = self.queued[lane].get(user_id, 0) + 1
+        return position
+
+    def dequeued(self, user_id, lane):
+        """A request registered with enqueued() was admitted to run or was dropped."""
+        self.queued[lane][user_id] -= 1
+        if not self.queued[lane][user_id]:
+            del self.queued[lane][user_id]
+
+    def pending_counts(self, lane):
+        counts = dict(self.queued[lane])
+        # Waiters that were not registered with enqueued(), e.g. intent checks
+        for waiter in self.waiters:
+            if waiter.lane == lane and not waiter.queued:
+                counts[waiter.user_id] = counts.get(waiter.user_id, 0) + 1
+        return counts
+
+    def position(self, user_id, lane):
+        # The user's own pending requests go first, every other user of the lane gets as many turns meanwhile
+        counts = self.pending_counts(lane)
+        own = counts.pop(user_id, 0)
+        ahead = own + sum(min(count, own + 1) for count in counts.values())
+        # Other lanes are served in proportion to their weights
+        turns = (ahead + 1) / self.lane_weights[lane]
+        for other_lane, weight in self.lane_weights.items():
+            if other_lane != lane:
+                ahead += min(sum(self.pending_counts(other_lane).values()), int(turns * weight))
+        return ahead + 1
+
+    async def acquire(self, user_id, lane, queued=False):
+        if self.active < self.capacity and not self.has_waiters():
+            self.active += 1
+            return
+
+        waiter = Waiter(user_id, lane, queued=queued)
+        self.waiters.append(waiter)
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+            elif not waiter.future.cancelled():
+                # Admitted just before the cancellation, hand the slot on
+                self.release()
+            raise
+
+    def release(self):
+        self.active -= 1
+        # Waiters cancelled before they could remove themselves do not get a turn
+        self.waiters = [waiter for waiter in self.waiters if not waiter.future.done()]
+        while self.active < self.capacity and self.waiters:
+            waiter = self.policy.pick(self.waiters)
+            self.waiters.remove(waiter)
+            self.active += 1
+            waiter.future.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, user_id, lane, queued=False):
+        """queued: the request is registered with enqueued() and counted there while it waits."""
+        await self.acquire(user_id, lane, queued)
+        try:
+            yield
+        finally:
+            self.release()
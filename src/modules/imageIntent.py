@@ -0,0 +1,127 @@
+import os
+import re
+import json
+import math
+from contextlib import nullcontext
+from datetime import datetime
+from loguru import logger
+
+# Phrases that settle the intent without asking the LLM
+image_request_patterns = [
+    re.compile(r"\b(draw|paint|sketch|illustrate)\b\s+(me\s+|us\s+)?(a|an|the|some|my|our|this|that)\b"),
+    re.compile(r"\b(generate|create|make|render)\b\s+(me\s+|us\s+)?(a\s+|an\s+|the\s+|some\s+)?(\w+\s+)?(image|picture|pic|photo|drawing|painting|illustration|artwork|portrait|wallpaper|logo|sketch)s?\b"),
+    re.compile(r"\b(image|picture|photo|drawing|painting)\s+of\b"),
+]
+not_image_request_patterns = [
+    re.compile(r"\bhow\s+(do|can|could|would|should)\s+(i|you|we)\b"),
+    re.compile(r"\b(create|generate|make|write)\s+(me\s+)?(a|an|the|some)?\s*(function|class|script|program|code|list|table|plan|summary|story|poem|email|letter|query|regex|account|file|document)s?\b"),
+    re.compile(r"\b(python|javascript|sql|html|css|json|excel|api)\b"),
+]
+ngram_pattern = re.compile(r"\w+")
+
+class NgramScorer():
+    """Naive Bayes over word unigrams and bigrams, trained from the logged LLM decisions."""
+    def __init__(self):
+        self.counts = {True: {}, False: {}}
+        self.totals = {True: 0, False: 0}
+        self.samples = {True: 0, False: 0}
+
+    @staticmethod
+    def features(message):
+        words = ngram_pattern.findall(message.lower())
+        return words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+
+    def train(self, message, wants_image):
+        for feature in self.features(message):
+            self.counts[wants_image][feature] = self.counts[wants_image].get(feature, 0) + 1
+            self.totals[wants_image] += 1
+        self.samples[wants_image] += 1
+
+    def is_trained(self, min_samples):
+        return self.samples[True] >= min_samples and self.samples[False] >= min_samples
+
+    def score(self, message):
+        """Probability that the message asks for an image."""
+        vocabulary = len(set(self.counts[True]) | set(self.counts[False])) or 1
+        log_odds = math.log((self.samples[True] + 1) / (self.samples[False] + 1))
+        for feature in self.features(message):
+            p_yes = (self.counts[True].get(feature, 0) + 1) / (self.totals[True] + vocabulary)
+            p_no = (self.counts[False].get(feature, 0) + 1) / (self.totals[False] + vocabulary)
+            log_odds += math.log(p_yes / p_no)
+        return 1 / (1 + math.exp(-max(min(log_odds, 50), -50)))
+
+
+class ImageIntentDetector():
+    """
+    Decides whether a message asks for an image in tiers: messages without a trigger word are no, clear phrases are
+    settled by rules, then an n-gram scorer trained from earlier LLM decisions settles confident scores. Only ambiguous
+    messages are sent to the LLM. Every decision is appended to log_path, which is also the scorer's training data.
+    """
+    def __init__(self, model_client_manager, trigger_words, intent_config):
+        self.model_client_manager = model_client_manager
+        self.trigger_words = trigger_words
+        self.log_path = intent_config.get("log_path", "./logs/image_intent.jsonl")
+        self.yes_threshold = intent_config.get("yes_threshold", 0.85)
+        self.no_threshold = intent_config.get("no_threshold", 0.15)
+        self.min_training_samples = intent_config.get("min_training_samples", 20)
+        self.scorer = NgramScorer()
+        self.load_training_data()
+
+    def load_training_data(self):
+        if not os.path.exists(self.log_path):
+            return
+        with open(self.log_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if entry.get("stage") == "llm":
+                    self.scorer.train(entry["message"], entry["decision"])
+        logger.info(f"Image intent scorer trained on {self.scorer.samples[True]} yes and {self.scorer.samples[False]} no decisions.")
+
+    def log_decision(self, message, stage, decision, score=None):
+        try:
+            os.makedirs(os.path.dirname(self.log_path) or ".", exist_ok=True)
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"timestamp": datetime.now().isoformat(), "message": message, "stage": stage, "score": score, "decision": decision}) + "\n")
+        except OSError as e:
+            logger.error(f"Failed to log image intent decision: {e}")
+
+    def rule_decision(self, message):
+        text = message.lower()
+        if any(pattern.search(text) for pattern in not_image_request_patterns):
+            return False
+        if any(pattern.search(text) for pattern in image_request_patterns):
+            return True
+        return None
+
+    async def wants_image(self, message, model_settings, llm_slot=None):
+        """llm_slot is held (as an async context manager) while the LLM is asked."""
+        text = message.lower()
+        if not any(word in text for word in self.trigger_words):
+            return False
+
+        decision = self.rule_decision(message)
+        if decision is not None:
+            self.log_decision(message, "rules", decision)
+            return decision
+
+        score = None
+        if self.scorer.is_trained(self.min_training_samples):
+            score = self.scorer.score(message)
+            if score >= self.yes_threshold or score <= self.no_threshold:
+                decision = score >= self.yes_threshold
+                self.log_decision(message, "scorer", decision, score)
+                return decision
+
+        async with llm_slot or nullcontext():
+            response, cached = await self.model_client_manager.ask_if_generate_image(message, model_settings)
+        decision = response.lower().strip().startswith('yes')
+        if cached:
+            # Already trained on when the LLM was asked, repeating it would inflate the training data
+            self.log_decision(message, "cache", decision, score)
+            return decision
+        self.scorer.train(message, decision)
+        self.log_decision(message, "llm", decision, score)
+        return decision
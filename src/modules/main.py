@@ -2,20 +2,18 @@ import os
 import sys
 import asyncio
 import discord
-from datetime import datetime
 from discord.ext import commands
 from discord import app_commands
 from loguru import logger
 from dotenv import load_dotenv
 from settings import handle_settings_command, handle_characters_command
-from utils import load_config, start_app
+from utils import load_config, launch_app
 from requestQueue import RequestQueue
 
 # Load environment variables from .env file
 load_dotenv()
 bot_token = os.getenv('DISCORD_BOT_TOKEN')
 config = load_config("config.json")
-rate_limit_per_user_per_minute = config['rate_limit_per_user_per_minute']
 ollama_app_path = os.getenv('OLLAMA_APP_PATH')
 
 logger.add("./logs/bot_logs.log", rotation="50 MB")
@@ -28,10 +26,9 @@ class DiscordBot(discord.Client):
         self.slash_command_tree = app_commands.CommandTree(self)
         self.queue = RequestQueue(self)
         self.users_in_settings = set()
-        self.user_message_timestamps = {}
 
         try:
-            start_app(ollama_app_path, "ollama.exe")
+            launch_app(ollama_app_path, "ollama.exe")
         except Exception as e:
             logger.error(f"Failed to start app on DiscordBot __init__: {e}")
 
@@ -40,27 +37,17 @@ class DiscordBot(discord.Client):
         if message.author == self.user or message.author.id in self.users_in_settings:
             return
         
-        # Rate limit check
-        user_id = message.author.id
-        current_time = datetime.now().timestamp()
-        if user_id not in self.user_message_timestamps:
-            self.user_message_timestamps[user_id] = []
-        
-        # Filter out timestamps older than 1 minute
-        self.user_message_timestamps[user_id] = [timestamp for timestamp in self.user_message_timestamps[user_id] if current_time - timestamp < 60]
-        
-        if len(self.user_message_timestamps[user_id]) >= rate_limit_per_user_per_minute:
-            await message.channel.send(f"{message.author.mention}, you are sending messages too quickly. Please slow down.", delete_after=5)
-            return
-        
-        # Add the current timestamp to the user's message timestamps
-        self.user_message_timestamps[user_id].append(current_time)
-
         bot_mention = f'<@{self.user.id}>'
         if (message.channel.name == f'llm-{message.author.name}' or
                 message.content.lower().startswith('hey llm') or
                 bot_mention in message.content.lower() or
                 (message.reference and message.reference.resolved and message.reference.resolved.author == self.user)):
+            # Rate limit check, only messages addressed to the bot count
+            guild_id = message.guild.id if message.guild else None
+            if not self.queue.rate_limiter.allow(message.author.id, "text", guild_id, message.channel.id):
+                await message.channel.send(f"{message.author.mention}, you are sending messages too quickly. Please slow down.", delete_after=5)
+                return
+
             content = message.content
             if content.lower().startswith('hey llm'):
                 content = content[8:]  # Remove "hey llm " from the start of the message
@@ -74,8 +61,17 @@ class DiscordBot(discord.Client):
         ready_logger = logger.bind(user=self.user.name, userid=self.user.id)
         ready_logger.info("Login Successful")
         await self.slash_command_tree.sync()
+        self.queue.conversation_store.start()
+        self.queue.reaction_manager.start()
         self.loop.create_task(self.queue.process_conversation())
 
+    async def close(self):
+        """Flush pending conversation logs and close the pooled model client connections before disconnecting."""
+        await self.queue.reaction_manager.close()
+        await self.queue.conversation_store.close()
+        await self.queue.model_client_manager.close()
+        await super().close()
+
     async def ensure_admin_channel(self, guild):
         for channel in guild.channels:
             if channel.name == 'llm-bot-admin' and isinstance(channel, discord.TextChannel):
@@ -100,9 +96,11 @@ async def on_reaction_add(reaction, user):
             return
         
         if reaction.emoji == "🔄":
-            await bot.queue.handle_reroll_reaction(reaction.message.id, user.id)
+            await bot.queue.handle_reroll_reaction(reaction.message.id, reaction.message.channel.id, user.id)
         if reaction.emoji == '🗑️':
-            await bot.queue.handle_delete_reaction(reaction.message.id, user.id)
+            await bot.queue.handle_delete_reaction(reaction.message.id, reaction.message.channel.id, user.id)
+        if reaction.emoji == '➕':
+            await bot.queue.handle_variation_reaction(reaction.message.id, reaction.message.channel.id, user.id)
     except Exception as e:
         logger.error(f"Failed to handle reaction: {e}")
 
@@ -122,6 +120,7 @@ async def setup_llm(interaction: discord.Interaction):
         "- **Chat with the bot:** Mention the bot or start your message with 'hey llm'. There is no need for the 'hey llm' trigger if you are in your private llm channel.\n"
         "- **Adjust settings:** Use the `/settings` command to specify which model to use and to modify conversation parameters.\n"
         "- **Assign the bot different Characters:** Use the `/characters` command to specify which characters to use.\n"
+        "- **More like this:** React with ➕ on a generated image to get variations of it.\n"
         "- **Clear history:** Use `/clearllmconversation` to delete the conversation history in this channel. Regular maintenance ensures optimal performance.\n\n"
         "Enjoy your conversations with the LLM bot!"
     )
@@ -160,8 +159,11 @@ async def clear_conversation(interaction: discord.Interaction):
     user_id = interaction.user.id
     conversation_id = f"{channel_id}_{user_id}"
     
-    message = bot.queue.clear_conversation_log(conversation_id, user_id)
-    await interaction.response.send_message(message, ephemeral=True, delete_after=10)
+    # Cancelling a running generation can take longer than the interaction deadline
+    await interaction.response.defer(ephemeral=True)
+    message = await bot.queue.clear_conversation_log(conversation_id, user_id)
+    msg = await interaction.followup.send(message, ephemeral=True)
+    await msg.delete(delay=10)
 
     channel = interaction.channel
     user_name = interaction.user.name
@@ -175,8 +177,9 @@ async def clear_conversation(interaction: discord.Interaction):
     user_id = interaction.user.id
     conversation_id = f"{channel_id}_{user_id}"
     
-    message = bot.queue.clear_conversation_log(conversation_id, user_id)
-    await interaction.response.send_message(message)
+    await interaction.response.defer()
+    message = await bot.queue.clear_conversation_log(conversation_id, user_id)
+    await interaction.followup.send(message)
 
     logger.info(f"Clear conversation attempt by user {user_id} in channel {channel_id}: {message}")
 
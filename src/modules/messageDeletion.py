@@ -0,0 +1,56 @@
+import asyncio
+import discord
+from datetime import timedelta
+from loguru import logger
+
+# Discord only bulk deletes messages younger than 14 days, keep a margin for clock skew
+bulk_delete_max_age = timedelta(days=14) - timedelta(minutes=10)
+bulk_delete_max_messages = 100
+
+
+async def delete_discord_messages(channel, message_ids, max_concurrency=5):
+    """
+    Delete messages by id without fetching them first. Recent messages are removed with the bulk delete endpoint,
+    older ones (and everything the bulk delete was not allowed to remove) are deleted one by one, at most
+    max_concurrency at a time. Returns the number of messages that could not be deleted.
+    """
+    message_ids = [message_id for message_id in message_ids if message_id]
+    if not message_ids:
+        return 0
+    if channel is None:
+        return len(message_ids)
+
+    now = discord.utils.utcnow()
+    recent = [message_id for message_id in message_ids if now - discord.utils.snowflake_time(message_id) < bulk_delete_max_age]
+    remaining = [message_id for message_id in message_ids if message_id not in recent]
+
+    # Bulk deletes take 2 to 100 messages and are not available in DMs
+    if hasattr(channel, "delete_messages") and len(recent) > 1:
+        for start in range(0, len(recent), bulk_delete_max_messages):
+            batch = recent[start:start + bulk_delete_max_messages]
+            try:
+                await channel.delete_messages([channel.get_partial_message(message_id) for message_id in batch])
+            except discord.HTTPException as e:
+                logger.debug(f"Bulk delete of {len(batch)} messages failed, deleting them one by one: {e}")
+                remaining.extend(batch)
+    else:
+        remaining.extend(recent)
+
+    slots = asyncio.Semaphore(max_concurrency)
+
+    async def delete_one(message_id):
+        async with slots:
+            try:
+                await channel.get_partial_message(message_id).delete()
+            except discord.NotFound:
+                pass # already deleted
+            except discord.HTTPException as e:
+                logger.error(f"Failed to delete message {message_id}: {e}")
+                return False
+            return True
+
+    results = await asyncio.gather(*(delete_one(message_id) for message_id in remaining))
+    failed = results.count(False)
+    if failed:
+        logger.warning(f"{failed} of {len(message_ids)} messages could not be deleted in channel {channel.id}.")
+    return failed
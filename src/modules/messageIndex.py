@@ -0,0 +1,40 @@
+class MessageIndex():
+    """
+    Reverse index from Discord message id to (conversation_id, message index) for the loaded conversations,
+    so reaction handling does not have to scan every conversation log.
+    """
+    def __init__(self):
+        self.locations = {} # message_id -> (conversation_id, position in conversation_log["messages"])
+        self.conversation_message_ids = {} # conversation_id -> set of indexed message ids
+
+    @staticmethod
+    def message_ids(message_entry):
+        message_ids = message_entry.get('message_ids') or []
+        # Older image entries stored a single id instead of a list
+        return message_ids if isinstance(message_ids, list) else [message_ids]
+
+    def add(self, conversation_id, position, message_entry):
+        for message_id in self.message_ids(message_entry):
+            if message_id:
+                self.locations[message_id] = (conversation_id, position)
+                self.conversation_message_ids.setdefault(conversation_id, set()).add(message_id)
+
+    def index_conversation(self, conversation_id, conversation_log):
+        """(Re)build the entries of a conversation, e.g. after it was loaded or its messages were rewritten."""
+        self.remove_conversation(conversation_id)
+        for position, message_entry in enumerate(conversation_log["messages"]):
+            self.add(conversation_id, position, message_entry)
+
+    def truncate(self, conversation_id, length):
+        """Drop the entries of messages at or after `length`."""
+        message_ids = self.conversation_message_ids.get(conversation_id, set())
+        for message_id in [message_id for message_id in message_ids if self.locations[message_id][1] >= length]:
+            del self.locations[message_id]
+            message_ids.discard(message_id)
+
+    def remove_conversation(self, conversation_id):
+        for message_id in self.conversation_message_ids.pop(conversation_id, set()):
+            self.locations.pop(message_id, None)
+
+    def lookup(self, message_id):
+        return self.locations.get(message_id)
@@ -0,0 +1,100 @@
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from loguru import logger
+from fairQueue import FairPolicy, Waiter
+
+
+class ModelBatchGate():
+    """
+    Semaphore for a backend (or a group of backends sharing a GPU) that groups requests by target model.
+
+    When a slot frees up, waiters for a model that is already running, or was admitted last, are preferred over
+    waiters for other models, so a batch of requests for one model is served before switching. Among the preferred
+    waiters (or all of them if there are none) users and lanes take turns as in the FairScheduler. A waiter that has
+    waited max_wait_seconds is admitted next regardless of its model, so nobody starves. With max_wait_seconds 0
+    models are not batched and the waiters are only ordered fairly.
+    """
+    def __init__(self, name, capacity, max_wait_seconds=0, lane_weights=None):
+        self.name = name
+        self.capacity = capacity
+        self.max_wait_seconds = max_wait_seconds
+        self.policy = FairPolicy(lane_weights)
+        self.running = {} # model_key -> number of admitted requests
+        self.last_model = None
+        self.waiters = [] # Waiter objects in arrival order
+        self.admitted = 0
+        self.switches = 0 # admissions for a different model than the previous one
+        self.switches_avoided = 0 # admissions that jumped older waiters for other models
+
+    def active(self):
+        return sum(self.running.values())
+
+    async def acquire(self, model_key, user_id=None, lane="public"):
+        if self.active() < self.capacity:
+            self.admit(model_key)
+            return
+
+        waiter = Waiter(user_id, lane, model_key)
+        self.waiters.append(waiter)
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+            elif not waiter.future.cancelled():
+                # Admitted just before the cancellation, hand the slot on
+                self.release(model_key)
+            raise
+
+    def release(self, model_key):
+        self.running[model_key] -= 1
+        if not self.running[model_key]:
+            del self.running[model_key]
+        # Waiters cancelled before they could remove themselves do not get a turn
+        self.waiters = [waiter for waiter in self.waiters if not waiter.future.done()]
+        while self.waiters and self.active() < self.capacity:
+            waiter = self.pick()
+            self.waiters.remove(waiter)
+            self.admit(waiter.model_key)
+            waiter.future.set_result(None)
+
+    def pick(self):
+        if self.max_wait_seconds > 0:
+            oldest = self.waiters[0]
+            if time.monotonic() - oldest.enqueued_at >= self.max_wait_seconds:
+                self.policy.served(oldest, self.waiters)
+                return oldest
+            preferred = set(self.running) or {self.last_model}
+            candidates = [waiter for waiter in self.waiters if waiter.model_key in preferred]
+            if candidates:
+                waiter = self.policy.pick(candidates, self.waiters)
+                if waiter.model_key != oldest.model_key:
+                    self.switches_avoided += 1
+                return waiter
+        return self.policy.pick(self.waiters)
+
+    def admit(self, model_key):
+        if self.last_model is not None and model_key != self.last_model:
+            self.switches += 1
+            logger.info(f"{self.name} switches from {self.last_model} to {model_key}: {self.stats()}")
+        self.last_model = model_key
+        self.running[model_key] = self.running.get(model_key, 0) + 1
+        self.admitted += 1
+
+    @asynccontextmanager
+    async def slot(self, model_key=None, user_id=None, lane="public"):
+        await self.acquire(model_key, user_id, lane)
+        try:
+            yield
+        finally:
+            self.release(model_key)
+
+    def stats(self):
+        return {
+            "admitted": self.admitted,
+            "switches": self.switches,
+            "switches_avoided": self.switches_avoided,
+            "running": dict(self.running),
+            "waiting": len(self.waiters)
+        }
@@ -0,0 +1,17 @@
+import time
+
+
+class QueuedRequest():
+    """A request waiting in the RequestQueue for a conversation."""
+    def __init__(self, conversation_id, message, is_image_gen, use_cache=True, user_id=None, lane="public", variation_of_seed=None):
+        self.conversation_id = conversation_id
+        self.message = message # user message, or the image prompt if is_image_gen
+        self.is_image_gen = is_image_gen
+        self.use_cache = use_cache # False bypasses the response cache, e.g. for rerolls
+        self.variation_of_seed = variation_of_seed # seed of the image to generate variations of
+        self.user_id = user_id
+        self.lane = lane # priority lane of the FairScheduler
+        self.position = None # estimated queue position when it was enqueued
+        self.queued = False # counted by FairScheduler.enqueued() until it is admitted to run or dropped
+        self.epoch = 0 # ConversationTracker epoch at enqueue time, the request is dropped once it changes
+        self.enqueued_at = time.monotonic()
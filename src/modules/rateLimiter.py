@@ -0,0 +1,71 @@
+import time
+from collections import OrderedDict, deque
+
+
+class SlidingWindowLimiter():
+    """
+    Allows at most limit events per window_seconds for each key. Every key keeps a deque of its event timestamps, old
+    timestamps are popped from the left, so a check is O(1) amortized. Keys are kept in order of their last event and
+    keys without events for idle_eviction_seconds are dropped, so memory stays bounded by the active users.
+    """
+    def __init__(self, window_seconds=60, idle_eviction_seconds=600):
+        self.window_seconds = window_seconds
+        self.idle_eviction_seconds = max(idle_eviction_seconds, window_seconds)
+        self.events = OrderedDict() # key -> deque of timestamps, least recently active key first
+
+    def allow(self, key, limit, now=None):
+        """Record an event for key and return True, or return False if key already used up its limit."""
+        now = time.monotonic() if now is None else now
+        self.evict_idle(now)
+
+        timestamps = self.events.get(key)
+        if timestamps is None:
+            timestamps = self.events[key] = deque()
+        while timestamps and now - timestamps[0] >= self.window_seconds:
+            timestamps.popleft()
+
+        if len(timestamps) >= limit:
+            return False
+        timestamps.append(now)
+        self.events.move_to_end(key)
+        return True
+
+    def evict_idle(self, now):
+        while self.events:
+            key, timestamps = next(iter(self.events.items()))
+            if timestamps and now - timestamps[-1] < self.idle_eviction_seconds:
+                break
+            del self.events[key]
+
+
+class RateLimiter():
+    """
+    Per user budgets for text and image generations. The default budgets can be overridden for a guild or a channel
+    in the "rate_limits" config section; a user's budget is then counted separately in that guild or channel.
+    """
+    def __init__(self, rate_limits_config):
+        self.defaults = {
+            "text": rate_limits_config.get("text_per_user", 5),
+            "image": rate_limits_config.get("image_per_user", 2)
+        }
+        self.guild_limits = rate_limits_config.get("guilds", {}) # guild_id -> {"text_per_user": n, "image_per_user": n}
+        self.channel_limits = rate_limits_config.get("channels", {}) # channel_id -> same
+        self.window = SlidingWindowLimiter(
+            window_seconds=rate_limits_config.get("window_seconds", 60),
+            idle_eviction_seconds=rate_limits_config.get("idle_eviction_seconds", 600)
+        )
+
+    def resolve(self, kind, guild_id, channel_id):
+        """Return the scope the budget is counted in and the limit of kind there."""
+        budget_name = f"{kind}_per_user"
+        channel_limits = self.channel_limits.get(str(channel_id), {})
+        if budget_name in channel_limits:
+            return f"channel:{channel_id}", channel_limits[budget_name]
+        guild_limits = self.guild_limits.get(str(guild_id), {})
+        if budget_name in guild_limits:
+            return f"guild:{guild_id}", guild_limits[budget_name]
+        return "global", self.defaults[kind]
+
+    def allow(self, user_id, kind="text", guild_id=None, channel_id=None):
+        scope, limit = self.resolve(kind, guild_id, channel_id)
+        return self.window.allow((kind, scope, user_id), limit)
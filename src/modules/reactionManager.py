@@ -0,0 +1,103 @@
+import asyncio
+import discord
+from collections import deque
+from loguru import logger
+
+
+class ReactionManager():
+    """
+    Keeps the 🔄 and 🗑️ reactions on the newest bot message of each conversation, off the request path.
+
+    Callers only record which message should carry the reactions; a background task applies the changes. Only the
+    latest target per conversation is applied, so a removal followed by an addition on the same message is skipped,
+    and since the manager remembers which message carries the reactions no message has to be fetched.
+    """
+    reactions = ('🔄', '🗑️')
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.carriers = {} # conversation_id -> (channel_id, message_id) carrying the reactions
+        self.targets = {} # conversation_id -> (channel_id, message_id) that should carry them, or None, not applied yet
+        self.additions = deque() # (channel_id, message_id, emoji) of reactions that stay on their message
+        self.changed = asyncio.Event()
+        self.task = None
+
+    def mark(self, conversation_id, channel_id, message_id):
+        """Move the reactions of the conversation to the message."""
+        self.targets[conversation_id] = (channel_id, message_id)
+        self.changed.set()
+
+    def unmark(self, conversation_id, channel_id=None, message_id=None):
+        """
+        Remove the reactions of the conversation. message_id is where they are assumed to be if the manager does not
+        know the conversation yet, e.g. after a restart.
+        """
+        if conversation_id not in self.carriers and message_id:
+            self.carriers[conversation_id] = (channel_id, message_id)
+        self.targets[conversation_id] = None
+        self.changed.set()
+
+    def add_reaction(self, channel_id, message_id, emoji):
+        """Add a reaction that is not moved to later messages, e.g. ➕ on generated images."""
+        self.additions.append((channel_id, message_id, emoji))
+        self.changed.set()
+
+    def forget(self, conversation_id):
+        """The message carrying the reactions or the whole conversation was deleted."""
+        self.carriers.pop(conversation_id, None)
+        self.targets.pop(conversation_id, None)
+
+    def start(self):
+        # on_ready fires again after a reconnect, keep a single background task
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await self.changed.wait()
+            self.changed.clear()
+            while self.targets:
+                conversation_id = next(iter(self.targets))
+                try:
+                    await self.apply(conversation_id, self.targets.pop(conversation_id))
+                except Exception as e:
+                    logger.error(f"Failed to update the reactions of {conversation_id}: {e}")
+            while self.additions:
+                channel_id, message_id, emoji = self.additions.popleft()
+                channel = self.bot.get_channel(channel_id)
+                if channel is None:
+                    continue
+                try:
+                    await channel.get_partial_message(message_id).add_reaction(emoji)
+                except discord.HTTPException as e:
+                    logger.debug(f"Failed to add reaction {emoji} on message {message_id}: {e}")
+
+    async def apply(self, conversation_id, target):
+        carrier = self.carriers.get(conversation_id)
+        if carrier == target:
+            return
+        if carrier is not None:
+            await self.update(carrier, add=False)
+            del self.carriers[conversation_id]
+        if target is not None:
+            await self.update(target, add=True)
+            self.carriers[conversation_id] = target
+
+    async def update(self, location, add):
+        channel_id, message_id = location
+        channel = self.bot.get_channel(channel_id)
+        if channel is None:
+            return
+        message = channel.get_partial_message(message_id)
+        for emoji in self.reactions:
+            try:
+                if add:
+                    await message.add_reaction(emoji)
+                else:
+                    await message.remove_reaction(emoji, self.bot.user)
+            except discord.HTTPException as e:
+                logger.debug(f"Failed to {'add' if add else 'remove'} reaction {emoji} on message {message_id}: {e}")
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
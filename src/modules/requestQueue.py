@@ -1,36 +1,101 @@
 import asyncio
+import io
 import os
-import json
+import time
 import shutil
 import discord
+from collections import deque
 from loguru import logger
 from datetime import datetime
 from utils import load_config
 from settings import load_settings
 from ModelClientHandler import ModelClientManager
+from messageIndex import MessageIndex
+from conversationTracker import ConversationTracker
+from contextBuilder import build_context, prompt_budget
+from summarizer import ConversationSummarizer
+from imageIntent import ImageIntentDetector
+from queuedRequest import QueuedRequest
+from modelBatching import ModelBatchGate
+from fairQueue import FairScheduler
+from rateLimiter import RateLimiter
+from reactionManager import ReactionManager
+from messageDeletion import delete_discord_messages
+from conversationStore import ConversationCache, SQLiteConversationStore, create_conversation_store, migrate_file_logs
 
 settings = load_settings("./src/settings/user_settings.json")
 log_folder = "./logs/conversations"
 
 class RequestQueue():
     def __init__(self, bot):
-        self.queue = asyncio.Queue() # Queue of (conversation_id, message, is_image_gen) tuples
-        self.conversation_logs = {}
+        self.queue = asyncio.Queue() # Queue of QueuedRequest objects, add items with enqueue()
         self.bot = bot
         self.model_client_manager = ModelClientManager()
 
         self.config = load_config('./config.json')
         self.image_gen_trigger_words = self.config.get('image_gen_trigger_words', [])
-        
+        self.image_intent_detector = ImageIntentDetector(self.model_client_manager, self.image_gen_trigger_words, self.config.get('image_intent', {}))
+        self.rate_limiter = RateLimiter(self.config.get('rate_limits', {}))
+        self.reaction_manager = ReactionManager(bot)
+
+        # Conversation logs are loaded from the store on first access and evicted again when idle
+        store_config = self.config.get('conversation_store', {})
+        self.conversation_store = create_conversation_store(store_config, log_folder)
+        self.message_index = MessageIndex()
+        self.conversation_logs = ConversationCache(
+            self.conversation_store,
+            max_loaded=store_config.get('max_loaded_conversations', 200),
+            idle_seconds=store_config.get('idle_eviction_seconds', 1800),
+            can_evict=self.is_idle,
+            on_load=self.message_index.index_conversation,
+            on_evict=self.message_index.remove_conversation
+        )
+
+        # Worker pool: requests of one conversation run in order, different conversations run in parallel
+        worker_pool_config = self.config.get('worker_pool', {})
+        # Worker slots are handed out fairly across users and priority lanes
+        fair_queue_config = self.config.get('fair_queue', {})
+        self.fair_scheduler = FairScheduler(worker_pool_config.get('max_workers', 1), fair_queue_config.get('lane_weights'))
+        self.announce_position_from = fair_queue_config.get('announce_position_from', 0)
+        self.default_backend_concurrency = worker_pool_config.get('default_backend_concurrency', 1)
+        self.backend_concurrency = worker_pool_config.get('backend_concurrency', {})
+        # Backends in one group (e.g. local backends sharing a GPU) share their slots, named after the group
+        self.backend_groups = {backend: group for group, backends in worker_pool_config.get('backend_groups', {}).items() for backend in backends}
+        self.model_batching_max_wait = self.config.get('model_batching', {}).get('max_wait_seconds', 0)
+        self.backend_slots = {} # backend or group name -> ModelBatchGate
+        self.conversation_queues = {} # conversation_id -> deque of QueuedRequest objects
+        self.conversation_workers = {} # conversation_id -> asyncio.Task draining conversation_queues[conversation_id]
+        self.running_requests = {} # conversation_id -> asyncio.Task of the request in progress, see cancel_requests()
+        self.conversation_tracker = ConversationTracker()
+
+        # Text requests of a conversation that queue up behind each other are answered with one generation
+        coalescing_config = self.config.get('coalescing', {})
+        self.coalescing_enabled = coalescing_config.get('enabled', False)
+        self.debounce_seconds = coalescing_config.get('debounce_seconds', 1.0)
+        self.max_debounce_seconds = coalescing_config.get('max_debounce_seconds', 5.0)
+
+        streaming_config = self.config.get('streaming', {})
+        self.streaming_enabled = streaming_config.get('enabled', False)
+        self.stream_edit_interval = streaming_config.get('edit_interval_seconds', 1.0)
+
+        self.response_reserve_ratio = self.config.get('context', {}).get('response_reserve_ratio', 0.25)
+
+        image_generation_config = self.config.get('image_generation', {})
+        self.image_progress_updates = image_generation_config.get('progress_updates', False)
+        self.image_progress_interval = image_generation_config.get('progress_interval_seconds', 2.0)
+        self.image_variation_strength = image_generation_config.get('variation_strength', 0.35)
+        self.image_archive_tasks = set() # background writes of generated images to the log folder
+        self.summarizer = ConversationSummarizer(self, self.config.get('summarization', {}))
+
     def load_conversation_logs(self):
-        if os.path.exists(log_folder):
-            for filename in os.listdir(log_folder):
-                if filename.endswith(".json"):
-                    log_file_path = os.path.join(log_folder, filename)
-                    with open(log_file_path, "r") as file:
-                        conversation_id = filename[:-5]  # Remove '.json' extension
-                        self.conversation_logs[conversation_id] = json.load(file)
-                        logger.info(f"Loaded conversation log for {conversation_id}")
+        """Prepare the conversation store. Logs themselves are loaded lazily by ConversationCache."""
+        if isinstance(self.conversation_store, SQLiteConversationStore):
+            migrated = migrate_file_logs(log_folder, self.conversation_store)
+            if migrated:
+                logger.info(f"Imported {migrated} file based conversation logs into {self.conversation_store.db_path}")
+
+    def is_idle(self, conversation_id):
+        return not self.conversation_tracker.is_busy(conversation_id)
 
     async def add_conversation(self, channel_id, user_id, message, role, message_id=None, create_empty=False):
         conversation_id = f"{channel_id}_{user_id}"
@@ -49,226 +114,526 @@ class RequestQueue():
                 "assistant_system_prompt": settings['characters']['Assistant']['system_prompt'],
                 "messages": [{"role": "system", "content": settings['characters']['Assistant']['system_prompt'], "type": "character_msg"}]
             }
+            self.save_conversation_log(conversation_id)
 
         if not create_empty:
             conversation_log = self.conversation_logs[conversation_id]
             channel = self.bot.get_channel(conversation_log["channel_id"])
 
             # if image prompt
-            # Check if the message contains any image generation trigger word and ask the llm to confirm if an image needs to be generated
-            if any(word in message.lower() for word in self.image_gen_trigger_words):
-                # if llama3-8b via Groq is available use it, otherwise use the model of the current conversation
-                model_settings = settings["model_text"]["choices"].get("llama3-8b-8192 (via Groq)", settings["model_text"]["choices"][self.conversation_logs[conversation_id]["model_text"]])
-                response = self.model_client_manager.ask_if_generate_image(message, model_settings)
+            # Trigger words, rules and a scorer trained on earlier decisions settle clear cases, only ambiguous messages are sent to the llm
+            # if llama3-8b via Groq is available use it, otherwise use the model of the current conversation
+            model_settings = settings["model_text"]["choices"].get("llama3-8b-8192 (via Groq)", settings["model_text"]["choices"][self.conversation_logs[conversation_id]["model_text"]])
+            intent_slot = self.fair_scheduler.slot(user_id, "intent")
+            if await self.image_intent_detector.wants_image(message, model_settings, llm_slot=intent_slot):
+                # Image generations have their own, usually smaller, budget
+                guild_id = channel.guild.id if getattr(channel, "guild", None) else None
+                if not self.rate_limiter.allow(user_id, "image", guild_id, channel_id):
+                    await channel.send(f"<@{user_id}>, you are generating images too quickly. Please slow down.", delete_after=5)
+                    return
 
-                if response.lower().strip() == 'yes':
+                self.unmark_last_message(conversation_id)
+                message_entry = {"role": role, "content": message, "message_ids": []}
+                if role == 'user':
+                    message_entry["message_ids"] = [message_id]
+                self.append_message(conversation_id, message_entry)
 
-                    try:
-                        last_msg_id = conversation_log['messages'][-1]['message_ids'][-1]
-                        if last_msg_id:
-                            last_msg = await channel.fetch_message(last_msg_id)
-                            for reaction in last_msg.reactions:
-                                if reaction.emoji == '🔄' and reaction.me:
-                                    await reaction.remove(self.bot.user)
-                                if reaction.emoji == '🗑️' and reaction.me:
-                                    await reaction.remove(self.bot.user)
-                    except Exception as e:
-                        logger.error(f"Failed to fetch or edit message for reaction removal: {e}")
-
-                    message_entry = {"role": role, "content": message, "message_ids": []}
-                    if role == 'user':
-                        message_entry["message_ids"] = [message_id]
-                    conversation_log["messages"].append(message_entry)
-                    self.save_conversation_log(conversation_id)
-
-                    # Pre-process image prompt
-                    improved_prompt = self.model_client_manager.preprocess_image_prompt(conversation_log, model_settings)
-                    await self.queue.put((conversation_id, improved_prompt, True))
-                    return
-                
+                # Pre-process image prompt
+                async with self.fair_scheduler.slot(user_id, "intent"):
+                    improved_prompt = await self.model_client_manager.preprocess_image_prompt(conversation_log, model_settings)
+                await self.enqueue(conversation_id, improved_prompt, True)
+                return
+            
             # elif text prompt
             # Delete the reactions from the last message
-            try:
-                last_msg_id = conversation_log['messages'][-1]['message_ids'][-1]
-                if last_msg_id:
-                    last_msg = await channel.fetch_message(last_msg_id)
-                    for reaction in last_msg.reactions:
-                        if reaction.emoji == '🔄' and reaction.me:
-                            await reaction.remove(self.bot.user)
-                        if reaction.emoji == '🗑️' and reaction.me:
-                            await reaction.remove(self.bot.user)
-            except Exception as e:
-                logger.error(f"Failed to fetch or edit message for reaction removal: {e}")
+            self.unmark_last_message(conversation_id)
 
             message_entry = {"role": role, "content": message, "message_ids": []}
             if role == 'user':
                 message_entry["message_ids"] = [message_id]
-            self.conversation_logs[conversation_id]["messages"].append(message_entry)
-            self.save_conversation_log(conversation_id)
-            await self.queue.put((conversation_id, message, False))
-        else:
-            self.save_conversation_log(conversation_id)
+            self.append_message(conversation_id, message_entry)
+            await self.enqueue(conversation_id, message, False)
+
+    async def enqueue(self, conversation_id, message, is_image_gen, use_cache=True, variation_of_seed=None):
+        conversation_log = self.conversation_logs[conversation_id]
+        request = QueuedRequest(conversation_id, message, is_image_gen, use_cache, user_id=conversation_log["user_id"], lane=self.get_lane(conversation_log), variation_of_seed=variation_of_seed)
+        request.position = self.fair_scheduler.enqueued(request.user_id, request.lane)
+        request.queued = True
+        self.conversation_tracker.enqueued(conversation_id)
+        request.epoch = self.conversation_tracker.get(conversation_id).epoch
+        await self.queue.put(request)
+
+        if self.announce_position_from and request.position >= self.announce_position_from:
+            channel = self.bot.get_channel(conversation_log["channel_id"])
+            try:
+                await channel.send(f"<@{request.user_id}>, your request is number {request.position} in the queue.", delete_after=30)
+            except Exception as e:
+                logger.error(f"Failed to announce queue position: {e}")
+
+    def get_lane(self, conversation_log):
+        """Requests from a user's private llm-<name> channel go to the private lane, mentions elsewhere to the public lane."""
+        channel = self.bot.get_channel(conversation_log["channel_id"])
+        user = self.bot.get_user(conversation_log["user_id"])
+        if channel is not None and user is not None and channel.name == f"llm-{user.name}":
+            return "private"
+        return "public"
 
     async def get_conversation(self):
-        conversation_id, message, is_image_gen = await self.queue.get()
-        return conversation_id, message, is_image_gen
+        return await self.queue.get()
 
     async def process_conversation(self):
+        """Dispatch queued requests to one worker per conversation."""
         while True:
-            conversation_id, message, is_image_request = await self.get_conversation()
-            conversation_log = self.conversation_logs[conversation_id]
-            channel = self.bot.get_channel(conversation_log["channel_id"])
+            request = await self.get_conversation()
+            self.conversation_queues.setdefault(request.conversation_id, deque()).append(request)
+            if request.conversation_id not in self.conversation_workers:
+                self.conversation_workers[request.conversation_id] = asyncio.create_task(self.conversation_worker(request.conversation_id))
+
+    async def conversation_worker(self, conversation_id):
+        """Process the pending requests of a conversation in order, limited by the global and per-backend worker slots."""
+        pending = self.conversation_queues[conversation_id]
+        try:
+            while pending:
+                request = pending.popleft()
+                if conversation_id not in self.conversation_logs or self.conversation_tracker.is_cancelled(conversation_id, request.epoch):
+                    logger.info(f"Dropping cancelled request for {conversation_id}.")
+                    self.dequeue(request)
+                    self.conversation_tracker.dropped(conversation_id)
+                    continue
+
+                self.conversation_tracker.started(conversation_id)
+                task = asyncio.create_task(self.run_request(request, pending))
+                self.running_requests[conversation_id] = task
+                try:
+                    await asyncio.wait({task})
+                finally:
+                    del self.running_requests[conversation_id]
+                    self.conversation_tracker.finished(conversation_id)
+        finally:
+            del self.conversation_workers[conversation_id]
+            del self.conversation_queues[conversation_id]
+
+    async def run_request(self, request, pending):
+        """Wait for the slots and process a request, runs as a task so cancel_requests() can abort it."""
+        conversation_id = request.conversation_id
+        try:
+            if self.coalescing_enabled and not request.is_image_gen:
+                await self.wait_for_followups(pending)
+
+            model_key = self.get_model_key(conversation_id, request.is_image_gen)
+            backend = self.get_backend(conversation_id, request.is_image_gen)
+            # The backend slot is taken first, so requests waiting for a busy local GPU do not hold a worker slot
+            async with self.conversation_tracker.get(conversation_id).lock, self.get_backend_slots(backend, model_key, request.user_id, request.lane), self.fair_scheduler.slot(request.user_id, request.lane, queued=True):
+                self.dequeue(request)
+                if self.coalescing_enabled and not request.is_image_gen:
+                    self.coalesce(request, pending)
+                await self.handle_request(request)
+        except asyncio.CancelledError:
+            logger.info(f"Cancelled request for {conversation_id}.")
+        except Exception as e:
+            logger.error(f"Failed to process request for {conversation_id}: {e}")
+        finally:
+            self.dequeue(request)
+
+    def dequeue(self, request):
+        """Stop counting a request towards the queue positions, once it is admitted to run or dropped."""
+        if request.queued:
+            request.queued = False
+            self.fair_scheduler.dequeued(request.user_id, request.lane)
+
+    async def cancel_requests(self, conversation_id):
+        """
+        Drop the queued requests of a conversation and abort the one in progress, which closes its stream to the
+        backend. Called before the conversation is deleted, cleared or rerolled.
+        """
+        # Requests that are not dispatched yet are dropped by the worker once the epoch changed
+        self.conversation_tracker.cancel(conversation_id)
+        pending = self.conversation_queues.get(conversation_id)
+        while pending:
+            request = pending.popleft()
+            self.dequeue(request)
+            self.conversation_tracker.dropped(conversation_id)
 
-            if is_image_request:
-                # Handle image generation
-                prompt = message
-                model_settings = settings["model_img"]["choices"][conversation_log["model_img"]]
-                image_data = await self.model_client_manager.make_img_gen_call(prompt, model_settings)
-
-                if image_data:
-                    directory_path = f"./logs/conversations/img_{conversation_id}"
-                    if not os.path.exists(directory_path):
-                        os.makedirs(directory_path)
-
-                    image_path = f"{directory_path}/{datetime.now().strftime('%Y-%m-%dT%H-%M-%S.%f')}.png"
-                    
-                    with open(image_path, 'wb') as f:
-                        f.write(image_data)
-                    message = await channel.send(file=discord.File(image_path))
-                else:
-                    await channel.send("Failed to generate image.")
-
-                conversation_log["messages"].append({"role": "assistant", "content": "Sure! Here is your image with the prompt '{prompt}'). (The Image was send to the user using Stable Diffusion via an API)", "message_ids": message.id})
-
-            else:
-                # Handle text response
-                messages = [{"role": msg["role"], "content": msg["content"]} for msg in conversation_log["messages"]]
-                response = self.model_client_manager.make_llm_call(
-                    messages=messages,
-                    model_settings=settings["model_text"]["choices"][conversation_log["model_text"]],
-                    temperature=conversation_log["temperature"],
-                    max_tokens=conversation_log["max_tokens"],
-                    top_p=1,
-                    stream=False
+        task = self.running_requests.get(conversation_id)
+        if task is not None:
+            task.cancel()
+            await asyncio.wait({task})
+
+    async def wait_for_followups(self, pending):
+        """
+        A request without follow-ups starts right away, messages that arrive while it waits for its slots are still
+        merged by coalesce(). Once a follow-up arrived, the next one gets debounce_seconds to arrive, but the request is
+        delayed at most max_debounce_seconds.
+        """
+        deadline = time.monotonic() + self.max_debounce_seconds
+        while pending:
+            latest = pending[-1].enqueued_at
+            delay = min(latest + self.debounce_seconds, deadline) - time.monotonic()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    def coalesce(self, request, pending):
+        """
+        Merge the text requests queued directly behind request into it. Their messages are already in the log with
+        their own message_ids, so one reply generated from the log answers all of them.
+        """
+        merged = 0
+        while pending and not pending[0].is_image_gen:
+            followup = pending.popleft()
+            self.dequeue(followup)
+            self.conversation_tracker.dropped(followup.conversation_id)
+            request.message = followup.message
+            request.use_cache = request.use_cache and followup.use_cache
+            merged += 1
+        if merged:
+            logger.info(f"Coalesced {merged + 1} requests of {request.conversation_id} into one generation.")
+
+    def get_model_key(self, conversation_id, is_image_request):
+        """Key of the conversation's model in settings["model_text"/"model_img"]["choices"]."""
+        conversation_log = self.conversation_logs[conversation_id]
+        return conversation_log["model_img"] if is_image_request else conversation_log["model_text"]
+
+    def get_backend(self, conversation_id, is_image_request):
+        model_type = "model_img" if is_image_request else "model_text"
+        return settings[model_type]["choices"][self.get_model_key(conversation_id, is_image_request)]["api"]
+
+    def get_backend_slots(self, backend, model_key=None, user_id=None, lane="public"):
+        """Slot of the backend for a request to model_key, requests for the running model are preferred and users take turns."""
+        name = self.backend_groups.get(backend, backend)
+        if name not in self.backend_slots:
+            capacity = self.backend_concurrency.get(name, self.default_backend_concurrency)
+            self.backend_slots[name] = ModelBatchGate(name, capacity, self.model_batching_max_wait, self.fair_scheduler.lane_weights)
+        return self.backend_slots[name].slot(model_key, user_id, lane)
+
+    async def handle_request(self, request):
+        conversation_id = request.conversation_id
+        message = request.message
+        is_image_request = request.is_image_gen
+        conversation_log = self.conversation_logs[conversation_id]
+        channel = self.bot.get_channel(conversation_log["channel_id"])
+
+        if is_image_request:
+            # Handle image generation
+            prompt = message
+            model_settings = settings["model_img"]["choices"][conversation_log["model_img"]]
+            progress = {"message": None}
+            try:
+                images, seed = await self.model_client_manager.make_img_gen_call(
+                    prompt,
+                    model_settings,
+                    on_progress=(lambda fraction, eta: self.show_image_progress(channel, progress, fraction, eta)) if self.image_progress_updates else None,
+                    progress_interval=self.image_progress_interval,
+                    variation_of_seed=request.variation_of_seed,
+                    variation_strength=self.image_variation_strength
                 )
+            finally:
+                if progress["message"] is not None:
+                    try:
+                        await progress["message"].delete()
+                    except discord.HTTPException as e:
+                        logger.debug(f"Failed to delete image progress message: {e}")
 
-                response_message_ids = []
+            if not images:
+                await channel.send("Failed to generate image.")
+                return
 
-                chunks = [response[i:i+1900] for i in range(0, len(response), 1900)]
-                for chunk in chunks:
-                    message = await channel.send(chunk)
-                    response_message_ids.append(message.id)
+            # Upload from memory, up to 10 images per message, the archive copies are written in the background
+            timestamp = datetime.now().strftime('%Y-%m-%dT%H-%M-%S.%f')
+            file_names = [f"{timestamp}_{index}.png" if len(images) > 1 else f"{timestamp}.png" for index in range(len(images))]
+            image_message_ids = []
+            for start in range(0, len(images), 10):
+                files = [discord.File(io.BytesIO(image_data), filename=file_name) for image_data, file_name in zip(images[start:start + 10], file_names[start:start + 10])]
+                message = await channel.send(files=files)
+                image_message_ids.append(message.id)
+                if seed is not None:
+                    self.reaction_manager.add_reaction(channel.id, message.id, '➕')
+            for image_data, file_name in zip(images, file_names):
+                self.archive_image(f"{log_folder}/img_{conversation_id}", file_name, image_data)
 
-                conversation_log["messages"].append({"role": "assistant", "content": response, "message_ids": response_message_ids})
+            image_count = "your image" if len(images) == 1 else f"{len(images)} images"
+            self.append_message(conversation_id, {
+                "role": "assistant",
+                "content": f"Sure! Here is {image_count} with the prompt '{prompt}'. (The Image was send to the user using Stable Diffusion via an API)",
+                "message_ids": image_message_ids,
+                "image": {"prompt": prompt, "seed": seed}
+            })
+
+        elif self.streaming_enabled:
+            # Handle streamed text response
+            model_settings = settings["model_text"]["choices"][conversation_log["model_text"]]
+            stream = self.model_client_manager.stream_llm_call(
+                messages=self.build_prompt(conversation_id, conversation_log, model_settings),
+                model_settings=model_settings,
+                temperature=conversation_log["temperature"],
+                max_tokens=conversation_log["max_tokens"],
+                top_p=1,
+                use_cache=request.use_cache
+            )
+            streamed_response = {"content": "", "messages": []}
+            try:
+                await self.send_streamed_response(channel, stream, streamed_response)
+            finally:
+                # Log whatever was posted so reroll and delete can still clean it up after a failed stream
+                if streamed_response["messages"]:
+                    self.append_message(conversation_id, {"role": "assistant", "content": streamed_response["content"], "message_ids": [msg.id for msg in streamed_response["messages"]]})
+            if not streamed_response["messages"]:
+                logger.warning(f"Empty streamed response for {conversation_id}.")
+                return
+            message = streamed_response["messages"][-1]
+            self.summarizer.maybe_schedule(conversation_id)
+
+        else:
+            # Handle text response
+            model_settings = settings["model_text"]["choices"][conversation_log["model_text"]]
+            response = await self.model_client_manager.make_llm_call(
+                messages=self.build_prompt(conversation_id, conversation_log, model_settings),
+                model_settings=model_settings,
+                temperature=conversation_log["temperature"],
+                max_tokens=conversation_log["max_tokens"],
+                top_p=1,
+                stream=False,
+                use_cache=request.use_cache
+            )
+
+            response_message_ids = []
+
+            chunks = [response[i:i+1900] for i in range(0, len(response), 1900)]
+            for chunk in chunks:
+                message = await channel.send(chunk)
+                response_message_ids.append(message.id)
+
+            self.append_message(conversation_id, {"role": "assistant", "content": response, "message_ids": response_message_ids})
+            self.summarizer.maybe_schedule(conversation_id)
+
+        self.reaction_manager.mark(conversation_id, channel.id, message.id)
+
+    async def show_image_progress(self, channel, progress, fraction, eta_seconds):
+        text = f"Generating image... {fraction:.0%}" + (f" (about {eta_seconds:.0f}s left)" if eta_seconds else "")
+        if progress["message"] is None:
+            progress["message"] = await channel.send(text)
+        else:
+            await progress["message"].edit(content=text)
+
+    def archive_image(self, directory_path, file_name, image_data):
+        def write():
+            os.makedirs(directory_path, exist_ok=True)
+            with open(os.path.join(directory_path, file_name), 'wb') as f:
+                f.write(image_data)
+
+        task = asyncio.create_task(asyncio.to_thread(write))
+        self.image_archive_tasks.add(task)
+        task.add_done_callback(self.image_archive_done)
+
+    def image_archive_done(self, task):
+        self.image_archive_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Failed to archive generated image: {task.exception()}")
+
+    def unmark_last_message(self, conversation_id):
+        """Remove the reactions from the conversation's last message, they move to the next reply."""
+        messages = self.conversation_logs[conversation_id]['messages']
+        last_msg_id = messages[-1]['message_ids'][-1] if messages and messages[-1]['message_ids'] else None
+        self.reaction_manager.unmark(conversation_id, self.conversation_logs[conversation_id]["channel_id"], last_msg_id)
+
+    def build_prompt(self, conversation_id, conversation_log, model_settings):
+        """Fit the conversation into the prompt budget of the model, keeping the character messages."""
+        budget = prompt_budget(model_settings, conversation_log["max_tokens"], self.response_reserve_ratio)
+        messages, trimmed_tokens = build_context(conversation_log, budget)
+        if trimmed_tokens:
+            logger.info(f"Trimmed {trimmed_tokens} tokens of old messages from the prompt of {conversation_id} (budget {budget} tokens).")
+        return messages
+
+    async def send_streamed_response(self, channel, stream, streamed_response):
+        """
+        Post the response while it is generated: the first message is sent with the first tokens and then edited in place,
+        at most once per edit interval. Every 1900 characters a new message is started.
+        The text and the sent messages are collected in streamed_response.
+        """
+        loop = asyncio.get_running_loop()
+        sent_messages = streamed_response["messages"]
+        message_start = 0 # offset of the current Discord message within the response
+        current_message = None
+        shown_text = "" # text currently visible in current_message
+        last_edit = 0
+
+        async with channel.typing():
+            async for token in stream:
+                streamed_response["content"] += token
+                response = streamed_response["content"]
+
+                # Roll over to a new message at the 1900 character boundary
+                while len(response) - message_start > 1900:
+                    chunk = response[message_start:message_start + 1900]
+                    if current_message is None:
+                        sent_messages.append(await channel.send(chunk))
+                    elif shown_text != chunk:
+                        await current_message.edit(content=chunk)
+                    message_start += 1900
+                    current_message = None
+
+                pending_text = response[message_start:]
+                if current_message is None:
+                    if pending_text.strip():
+                        current_message = await channel.send(pending_text)
+                        sent_messages.append(current_message)
+                        shown_text = pending_text
+                        last_edit = loop.time()
+                elif loop.time() - last_edit >= self.stream_edit_interval and shown_text != pending_text:
+                    await current_message.edit(content=pending_text)
+                    shown_text = pending_text
+                    last_edit = loop.time()
+
+        pending_text = streamed_response["content"][message_start:]
+        if current_message is None and pending_text.strip():
+            sent_messages.append(await channel.send(pending_text))
+        elif current_message is not None and shown_text != pending_text:
+            await current_message.edit(content=pending_text)
 
-            await message.add_reaction('🔄')
-            await message.add_reaction('🗑️')
-            self.save_conversation_log(conversation_id)
-            
     def save_conversation_log(self, conversation_id):
-        if not os.path.exists(log_folder):
-            os.makedirs(log_folder)
-        log_file = f"{log_folder}/{conversation_id}.json"
-        with open(log_file, "w") as f:
-            json.dump(self.conversation_logs[conversation_id], f, indent=4)
-
-    async def handle_reroll_reaction(self, message_id, user_id):
-        for conversation_id, log in self.conversation_logs.items():
-            for msg in log['messages']:
-                if user_id == log['user_id'] and message_id in msg.get('message_ids', []):
-                    is_active = any(item[0] == conversation_id for item in self.queue._queue)
-                    if is_active:
-                        logger.info("Cannot reroll while messages from the same conversation are processing.")
-                        return
-                    await self.reroll_messages(log, conversation_id, user_id)
-                    break
+        """Persist the whole conversation log. Use append_message for the hot path."""
+        conversation_log = self.conversation_logs[conversation_id]
+        self.message_index.index_conversation(conversation_id, conversation_log)
+        self.conversation_store.save(conversation_id, conversation_log)
+
+    def append_message(self, conversation_id, message_entry):
+        messages = self.conversation_logs[conversation_id]["messages"]
+        messages.append(message_entry)
+        self.message_index.add(conversation_id, len(messages) - 1, message_entry)
+        self.conversation_store.append_message(conversation_id, message_entry)
+
+    def truncate_messages(self, conversation_id):
+        """Persist and re-index a conversation after messages were removed from its end."""
+        conversation_log = self.conversation_logs[conversation_id]
+        length = len(conversation_log["messages"])
+        self.message_index.truncate(conversation_id, length)
+        self.conversation_store.truncate_messages(conversation_id, length)
+
+        if self.summarizer.covered_count(conversation_log) > len(self.summarizer.history(conversation_log)):
+            # The summary covers deleted messages, drop it so it is rebuilt from the remaining ones
+            self.summarizer.cancel(conversation_id)
+            conversation_log["summary"] = None
+            self.conversation_store.update_meta(conversation_id, conversation_log)
+
+    def find_conversation(self, message_id, channel_id, user_id):
+        """Return the id of the user's conversation that contains the Discord message, or None."""
+        location = self.message_index.lookup(message_id)
+        if location is None:
+            # Only loaded conversations are indexed, so load the user's conversation of this channel and look again
+            conversation_id = f"{channel_id}_{user_id}"
+            if not self.conversation_logs.ensure_loaded(conversation_id):
+                return None
+            location = self.message_index.lookup(message_id)
+            if location is None:
+                return None
+
+        conversation_id, _ = location
+        if self.conversation_logs[conversation_id]['user_id'] != user_id:
+            return None
+        return conversation_id
+
+    async def handle_reroll_reaction(self, message_id, channel_id, user_id):
+        conversation_id = self.find_conversation(message_id, channel_id, user_id)
+        if conversation_id is None:
+            return
+        await self.cancel_requests(conversation_id)
+        async with self.conversation_tracker.locked(conversation_id):
+            await self.reroll_messages(self.conversation_logs[conversation_id], conversation_id, user_id)
 
     async def reroll_messages(self, conversation_log, conversation_id, user_id):
         channel = self.bot.get_channel(conversation_log["channel_id"])
-        for message in reversed(conversation_log['messages']):
-            for msg_id in message['message_ids']:
-                try:
-                    msg = await channel.fetch_message(msg_id)
-                    await msg.delete()
-                except Exception as e:
-                    logger.error(f"Failed to delete message: {e}")
-            conversation_log['messages'].remove(message)
+        message_ids = []
+        while conversation_log['messages']:
+            message = conversation_log['messages'].pop()
+            message_ids.extend(message['message_ids'])
             if message['role'] == 'assistant':  # Stop once the last LLM message is deleted
                 break
+        self.truncate_messages(conversation_id)
+        await delete_discord_messages(channel, message_ids)
+        self.reaction_manager.forget(conversation_id)
         # Re-add the delete reaction to the new last message if exists
         if conversation_log['messages']:
             try:
                 last_msg_id = conversation_log['messages'][-1]['message_ids'][-1]
                 if last_msg_id:
                     last_msg = conversation_log['messages'][-1]
-                    self.save_conversation_log(conversation_id)
-                    await self.queue.put((conversation_id, last_msg, False))
+                    await self.enqueue(conversation_id, last_msg, False, use_cache=False)
             except Exception as e:
                 logger.info(f"No message to add a reaction to: {e}")
 
-    async def handle_delete_reaction(self, message_id, user_id):
-        for conversation_id, log in self.conversation_logs.items():
-            for msg in log['messages']:
-                if user_id == log['user_id'] and message_id in msg.get('message_ids', []):
-                    is_active = any(item[0] == conversation_id for item in self.queue._queue)
-                    if is_active:
-                        logger.info("Cannot delete messages while messages from the same conversation are processing.")
-                        return
-                    await self.delete_messages(log, conversation_id)
-                    break
+    async def handle_variation_reaction(self, message_id, channel_id, user_id):
+        """Generate variations of an image, reusing its improved prompt and seed."""
+        conversation_id = self.find_conversation(message_id, channel_id, user_id)
+        if conversation_id is None:
+            return
+        conversation_log = self.conversation_logs[conversation_id]
+        _, position = self.message_index.lookup(message_id)
+        image = conversation_log['messages'][position].get("image")
+        if not image or image["seed"] is None:
+            return
+
+        channel = self.bot.get_channel(channel_id)
+        guild_id = channel.guild.id if getattr(channel, "guild", None) else None
+        if not self.rate_limiter.allow(user_id, "image", guild_id, channel_id):
+            await channel.send(f"<@{user_id}>, you are generating images too quickly. Please slow down.", delete_after=5)
+            return
+
+        self.unmark_last_message(conversation_id)
+        self.append_message(conversation_id, {"role": "user", "content": "Generate more images like this one.", "message_ids": []})
+        await self.enqueue(conversation_id, image["prompt"], True, variation_of_seed=image["seed"])
+
+    async def handle_delete_reaction(self, message_id, channel_id, user_id):
+        conversation_id = self.find_conversation(message_id, channel_id, user_id)
+        if conversation_id is None:
+            return
+        await self.cancel_requests(conversation_id)
+        async with self.conversation_tracker.locked(conversation_id):
+            await self.delete_messages(self.conversation_logs[conversation_id], conversation_id)
 
     async def delete_messages(self, conversation_log, conversation_id):
         channel = self.bot.get_channel(conversation_log["channel_id"])
-        for message in reversed(conversation_log['messages']):
-            for msg_id in message['message_ids']:
-                try:
-                    msg = await channel.fetch_message(msg_id)
-                    await msg.delete()
-                except Exception as e:
-                    logger.error(f"Failed to delete message: {e}")
-            conversation_log['messages'].remove(message)
+        message_ids = []
+        while conversation_log['messages']:
+            message = conversation_log['messages'].pop()
+            message_ids.extend(message['message_ids'])
             if message['role'] == 'user':  # Stop once the last message is deleted
                 break
 
-        self.save_conversation_log(conversation_id)
-        # Re-add the delete reaction to the new last message if exists
-        if conversation_log['messages']:
-            try:
-                last_msg_id = conversation_log['messages'][-1]['message_ids'][-1]
-                if last_msg_id:
-                    last_msg = await channel.fetch_message(last_msg_id)
-                    await last_msg.add_reaction('🔄')
-                    await last_msg.add_reaction('🗑️')
-            except Exception as e:
-                logger.info(f"No message to add a reaction to: {e}")
+        self.truncate_messages(conversation_id)
+        await delete_discord_messages(channel, message_ids)
+        # The message carrying the reactions is gone, re-add them to the new last message if exists
+        self.reaction_manager.forget(conversation_id)
+        if conversation_log['messages'] and conversation_log['messages'][-1]['message_ids']:
+            last_msg_id = conversation_log['messages'][-1]['message_ids'][-1]
+            if last_msg_id:
+                self.reaction_manager.mark(conversation_id, conversation_log["channel_id"], last_msg_id)
 
-    def clear_conversation_log(self, conversation_id, user_id):
-        log_file = f"./logs/conversations/{conversation_id}.json"
-        image_folder = f"./logs/conversations/img_{conversation_id}"
-        
-        if os.path.exists(log_file):
-            try:
-                with open(log_file, "r") as f:
-                    conversation_log = json.load(f)
-                    if conversation_log["user_id"] == user_id:
-                        if self.queue.qsize() == 0:
-                            self.conversation_logs.pop(conversation_id, None)
-                            f.close()
-                            os.remove(log_file)
-                            
-                            # Delete the image folder if it exists
-                            if os.path.exists(image_folder):
-                                shutil.rmtree(image_folder)
-                            
-                            logger.info(f"Conversation log and image folder cleared for {conversation_id}.")
-                            return "Conversation log and image folder cleared."
-                        else:
-                            return "Cannot clear conversation log while messages are in the queue."
-                    else:
-                        return "You can only clear conversations that you started."
-            except Exception as e:
-                logger.error(f"Failed to clear conversation log for {conversation_id}: {e}")
-                return "Failed to access or clear the conversation log due to an error."
-        else:
-            logger.error(f"Conversation log file not found for {conversation_id}.")
+    async def clear_conversation_log(self, conversation_id, user_id):
+        image_folder = f"{log_folder}/img_{conversation_id}"
+        conversation_log = self.conversation_logs.get(conversation_id)
+
+        if conversation_log is None:
+            logger.error(f"Conversation log not found for {conversation_id}.")
             return "No conversation log file found."
+
+        if conversation_log["user_id"] != user_id:
+            return "You can only clear conversations that you started."
+
+        await self.cancel_requests(conversation_id)
+        self.summarizer.cancel(conversation_id)
+
+        try:
+            self.conversation_logs.pop(conversation_id, None)
+            self.message_index.remove_conversation(conversation_id)
+            self.reaction_manager.forget(conversation_id)
+            self.conversation_store.delete(conversation_id)
+
+            # Delete the image folder if it exists
+            if os.path.exists(image_folder):
+                shutil.rmtree(image_folder)
+
+            logger.info(f"Conversation log and image folder cleared for {conversation_id}.")
+            return "Conversation log and image folder cleared."
+        except Exception as e:
+            logger.error(f"Failed to clear conversation log for {conversation_id}: {e}")
+            return "Failed to access or clear the conversation log due to an error."
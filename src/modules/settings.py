@@ -1,4 +1,3 @@
-import os
 import discord
 import json
 from loguru import logger
@@ -84,14 +83,10 @@ async def handle_model_selection(bot, interaction, model_client_manager, setting
     selected_model_settings = settings[setting_key]['choices'][selected_model_key]
 
     if selected_model_settings['api_type'] == "local":
-        required_vram = selected_model_settings.get("vram_usage_gb", 0)
-        # Check VRAM before applying settings
+        # Check VRAM before applying settings, the model is loaded by the VRAM scheduler on its first request
         if not model_client_manager.check_vram_availability(selected_model_settings.get("vram_usage_gb", 0)):
-            await channel.send("Insufficient VRAM to load this model. Please choose another model or unload models by deleting active conversations using these models.")
+            await channel.send("Insufficient VRAM to load this model. Please choose another model.")
             return await handle_model_selection(bot, interaction, model_client_manager, settings, setting_key, model_type)
-        
-        model_client_manager.update_vram_usage(bot, selected_model_key, required_vram)
-
 
     settings[setting_key]['value'] = selected_model_key
     if config['delete_messages']:
@@ -161,9 +156,7 @@ async def handle_numeric_setting(interaction, admin_channel, settings, key, min_
 
 def update_conversation_log_with_settings(bot, channel_id, user_id, settings):
     conversation_id = f"{channel_id}_{user_id}"
-    log_file = f"./logs/conversations/{conversation_id}.json"
 
-    # Update the conversation log in memory
     if conversation_id in bot.queue.conversation_logs:
         conversation_log = bot.queue.conversation_logs[conversation_id]
         conversation_log['model_text'] = settings['model_text']['value']
@@ -173,24 +166,9 @@ def update_conversation_log_with_settings(bot, channel_id, user_id, settings):
         conversation_log['character'] = settings['character_value']
         if conversation_log['character'] == 'Assistant':
             conversation_log['assistant_system_prompt'] = settings['characters']['Assistant']['system_prompt']
+            conversation_log['messages'][0]['content'] = settings['characters']['Assistant']['system_prompt']
         bot.queue.save_conversation_log(conversation_id)
 
-    # Update the conversation log in the file system
-    if os.path.exists(log_file):
-        with open(log_file, "r+") as f:
-            conversation_log = json.load(f)
-            conversation_log['model_text'] = settings['model_text']['value']
-            conversation_log['model_img'] = settings['model_img']['value']
-            conversation_log['temperature'] = settings['temperature']['value']
-            conversation_log['max_tokens'] = settings['max_tokens']['value']
-            conversation_log['character'] = settings['character_value']
-            if conversation_log['character'] == 'Assistant':
-                conversation_log['assistant_system_prompt'] = settings['characters']['Assistant']['system_prompt']
-                conversation_log['messages'][0]['content'] = settings['characters']['Assistant']['system_prompt']
-            f.seek(0)
-            json.dump(conversation_log, f, indent=4)
-            f.truncate()
-
 async def update_conversation_with_character(bot, channel_id, user_id, character_key, character, logger):
     conversation_id = f"{channel_id}_{user_id}"
     if conversation_id not in bot.queue.conversation_logs:
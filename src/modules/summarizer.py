@@ -0,0 +1,90 @@
+import asyncio
+from loguru import logger
+from settings import load_settings
+
+settings = load_settings("./src/settings/user_settings.json")
+
+summary_system_prompt = "You summarize conversations between a user and an AI assistant. Keep every fact, name, decision and open question that later messages might refer to. Answer with the summary only, in at most a few paragraphs."
+
+class ConversationSummarizer():
+    """
+    Folds the oldest messages of long conversations into conversation_log["summary"] in the background.
+
+    The summary is stored as {"content": ..., "message_count": n}, where n is the number of non-character messages
+    it covers. Once more than trigger_messages messages are not covered, everything except the newest
+    keep_recent_messages is folded into the existing summary, so the summary is extended instead of recomputed.
+    The raw messages stay in the log.
+    """
+    def __init__(self, request_queue, summarization_config):
+        self.request_queue = request_queue
+        self.enabled = summarization_config.get("enabled", False)
+        self.trigger_messages = summarization_config.get("trigger_messages", 30)
+        self.keep_recent_messages = max(2, summarization_config.get("keep_recent_messages", 10))
+        self.model = summarization_config.get("model", "llama3-8b-8192 (via Groq)")
+        self.max_tokens = summarization_config.get("max_tokens", 512)
+        self.tasks = {} # conversation_id -> running summarization task
+
+    @staticmethod
+    def history(conversation_log):
+        return [entry for entry in conversation_log["messages"] if entry.get("type") != "character_msg"]
+
+    @staticmethod
+    def covered_count(conversation_log):
+        summary = conversation_log.get("summary")
+        return summary["message_count"] if summary else 0
+
+    def maybe_schedule(self, conversation_id):
+        """Start a background summarization if the conversation has grown past the threshold."""
+        if not self.enabled or conversation_id in self.tasks:
+            return
+        conversation_log = self.request_queue.conversation_logs[conversation_id]
+        uncovered = len(self.history(conversation_log)) - self.covered_count(conversation_log)
+        if uncovered > self.trigger_messages:
+            task = asyncio.create_task(self.summarize(conversation_id))
+            self.tasks[conversation_id] = task
+            task.add_done_callback(lambda _: self.tasks.pop(conversation_id, None))
+
+    def cancel(self, conversation_id):
+        task = self.tasks.get(conversation_id)
+        if task is not None:
+            task.cancel()
+
+    async def summarize(self, conversation_id):
+        try:
+            conversation_log = self.request_queue.conversation_logs[conversation_id]
+            history = self.history(conversation_log)
+            covered = min(self.covered_count(conversation_log), len(history))
+            fold_until = len(history) - self.keep_recent_messages
+            if fold_until <= covered:
+                return
+
+            previous_summary = conversation_log["summary"]["content"] if covered else ""
+            transcript = "\n".join(f"{entry['role']}: {entry['content']}" for entry in history[covered:fold_until])
+            messages = [
+                {"role": "system", "content": summary_system_prompt},
+                {"role": "user", "content": f"Summary so far:\n{previous_summary or '(none)'}\n\nNew messages:\n{transcript}\n\nWrite the updated summary."}
+            ]
+
+            model_key = self.model if self.model in settings["model_text"]["choices"] else conversation_log["model_text"]
+            model_settings = settings["model_text"]["choices"][model_key]
+            async with self.request_queue.get_backend_slots(model_settings["api"], model_key):
+                summary = await self.request_queue.model_client_manager.make_llm_call(
+                    messages=messages,
+                    model_settings=model_settings,
+                    temperature=0.2,
+                    max_tokens=self.max_tokens,
+                    top_p=1,
+                    stream=False
+                )
+
+            if conversation_id not in self.request_queue.conversation_logs:
+                return
+            conversation_log = self.request_queue.conversation_logs[conversation_id]
+            if len(self.history(conversation_log)) < fold_until:
+                logger.info(f"Discarding summary of {conversation_id}, messages were deleted while it was generated.")
+                return
+            conversation_log["summary"] = {"content": summary.strip(), "message_count": fold_until}
+            self.request_queue.conversation_store.update_meta(conversation_id, conversation_log)
+            logger.info(f"Summarized messages {covered} to {fold_until} of {conversation_id}.")
+        except Exception as e:
+            logger.error(f"Failed to summarize conversation {conversation_id}: {e}")
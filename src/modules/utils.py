@@ -1,7 +1,9 @@
 import json
+import time
+import asyncio
+import aiohttp
 import psutil
 import subprocess
-import time
 from loguru import logger
 
 def load_config(filename):
@@ -19,10 +21,66 @@ def is_app_running(app_name):
     logger.info(f"Application '{app_name}' is not running.")
     return False
 
-def start_app(app_path, app_name):
-    """Start an application if it is not already running"""
+def launch_app(app_path, app_name):
+    """Launch an application without waiting for it, unless it is already running"""
     if not is_app_running(app_name):
         logger.info(f"Starting application '{app_name}' from path '{app_path}'.")
         subprocess.Popen(app_path, shell=True)
-        time.sleep(5)  # Wait for the application to fully initialize
-        logger.info(f"Application '{app_name}' should now be running.")
\ No newline at end of file
+
+class BackendLifecycle():
+    """
+    Keeps track of whether an HTTP backend is up. A successful probe is cached for ready_ttl seconds, so the
+    endpoint is not probed on every request. The application is only launched when the probe fails.
+    """
+    def __init__(self, probe_url, app_path=None, app_name=None, ready_ttl=30, probe_attempts=8, initial_backoff=0.25, max_backoff=4, probe_timeout=2):
+        self.probe_url = probe_url
+        self.app_path = app_path
+        self.app_name = app_name
+        self.ready_ttl = ready_ttl
+        self.probe_attempts = probe_attempts
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.probe_timeout = aiohttp.ClientTimeout(total=probe_timeout)
+        self.ready_until = 0
+        self.lock = asyncio.Lock()
+
+    def is_ready(self):
+        return time.monotonic() < self.ready_until
+
+    def mark_ready(self):
+        self.ready_until = time.monotonic() + self.ready_ttl
+
+    def mark_unready(self):
+        self.ready_until = 0
+
+    async def probe(self, session):
+        try:
+            async with session.get(self.probe_url, timeout=self.probe_timeout) as response:
+                return response.status < 500
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return False
+
+    async def ensure_ready(self, session):
+        """Return once the backend answers, launching it if necessary. Raises ConnectionError if it never becomes ready."""
+        if self.is_ready():
+            return
+        async with self.lock:
+            if self.is_ready():
+                return
+            if await self.probe(session):
+                self.mark_ready()
+                return
+
+            if self.app_path:
+                await asyncio.to_thread(launch_app, self.app_path, self.app_name)
+
+            backoff = self.initial_backoff
+            for _ in range(self.probe_attempts):
+                await asyncio.sleep(backoff)
+                if await self.probe(session):
+                    logger.info(f"Backend at '{self.probe_url}' is ready.")
+                    self.mark_ready()
+                    return
+                backoff = min(backoff * 2, self.max_backoff)
+
+            raise ConnectionError(f"Backend at '{self.probe_url}' did not become ready.")
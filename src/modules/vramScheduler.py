@@ -0,0 +1,105 @@
+import time
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from loguru import logger
+
+
+class ResidentModel():
+    def __init__(self, model_key, vram_gb):
+        self.model_key = model_key
+        self.vram_gb = vram_gb
+        self.in_flight = 0 # requests using the model, it is not evicted while this is above zero
+        self.last_used = time.monotonic()
+
+
+class VramScheduler():
+    """
+    Tracks which local models are loaded and how much VRAM they declare (vram_usage_gb in user_settings.json).
+
+    Requests hold a model with use(). Before a model is loaded, least recently used models without requests in flight
+    are unloaded until it fits into max_vram_gb. If the models in use leave no room, the request waits until one of
+    them is released. Unloading is delegated to unload_model(model_key), a coroutine function, so the scheduler can be
+    driven by a fake backend.
+    """
+    def __init__(self, max_vram_gb, unload_model):
+        self.max_vram_gb = max_vram_gb
+        self.unload_model = unload_model
+        self.models = OrderedDict() # model_key -> ResidentModel, least recently used first
+        self.changed = asyncio.Condition()
+
+    def used_gb(self):
+        return sum(model.vram_gb for model in self.models.values())
+
+    def can_fit(self, vram_gb):
+        """Whether the model can be loaded at all, possibly after evicting other models."""
+        return vram_gb <= self.max_vram_gb
+
+    async def acquire(self, model_key, vram_gb):
+        if not self.can_fit(vram_gb):
+            raise MemoryError(f"{model_key} needs {vram_gb} GB of VRAM, only {self.max_vram_gb} GB are available")
+
+        async with self.changed:
+            while model_key not in self.models:
+                await self.evict_idle(vram_gb)
+                if self.used_gb() + vram_gb <= self.max_vram_gb:
+                    self.models[model_key] = ResidentModel(model_key, vram_gb)
+                    logger.info(f"Reserved {vram_gb} GB of VRAM for {model_key}, {self.used_gb()} of {self.max_vram_gb} GB in use.")
+                    break
+                logger.info(f"Waiting for VRAM to load {model_key}, all loaded models are in use.")
+                await self.changed.wait()
+
+            model = self.models[model_key]
+            model.in_flight += 1
+            model.last_used = time.monotonic()
+            self.models.move_to_end(model_key)
+
+    async def evict_idle(self, vram_gb):
+        """Unload least recently used idle models until vram_gb fit. Must be called with self.changed held."""
+        for model in list(self.models.values()):
+            if self.used_gb() + vram_gb <= self.max_vram_gb:
+                return
+            if model.in_flight == 0:
+                await self.evict(model.model_key)
+
+    async def evict(self, model_key):
+        model = self.models.pop(model_key)
+        try:
+            await self.unload_model(model_key)
+            logger.info(f"Unloaded {model_key} to free {model.vram_gb} GB of VRAM.")
+        except Exception as e:
+            logger.error(f"Failed to unload {model_key}: {e}")
+
+    async def release(self, model_key):
+        async with self.changed:
+            model = self.models.get(model_key)
+            if model is not None:
+                model.in_flight -= 1
+                model.last_used = time.monotonic()
+            self.changed.notify_all()
+
+    @asynccontextmanager
+    async def use(self, model_key, vram_gb):
+        """Hold a model for the duration of a request."""
+        await self.acquire(model_key, vram_gb)
+        try:
+            yield
+        finally:
+            await self.release(model_key)
+
+    async def unload_all(self):
+        async with self.changed:
+            for model_key in [key for key, model in self.models.items() if model.in_flight == 0]:
+                await self.evict(model_key)
+
+    def state(self):
+        """Loaded models from least to most recently used, for inspection."""
+        now = time.monotonic()
+        return {
+            "max_vram_gb": self.max_vram_gb,
+            "used_gb": self.used_gb(),
+            "models": [
+                {"model": model.model_key, "vram_gb": model.vram_gb, "in_flight": model.in_flight, "idle_seconds": round(now - model.last_used, 1)}
+                for model in self.models.values()
+            ]
+        }
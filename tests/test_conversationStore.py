@@ -0,0 +1,105 @@
+import time
+import asyncio
+from conversationStore import JournalConversationStore, SQLiteConversationStore, ConversationCache
+
+
+def make_log(*contents):
+    return {"model": "test", "messages": [{"role": "user", "content": content} for content in contents]}
+
+
+def test_loading_past_max_loaded_keeps_the_requested_conversation(tmp_path):
+    store = JournalConversationStore(str(tmp_path))
+    store.write_pending({"c": [{"op": "snapshot", "log": make_log("stored")}]})
+    cache = ConversationCache(store, max_loaded=2)
+    # Two conversations with unwritten changes can not be evicted
+    cache["a"] = make_log("a")
+    cache["b"] = make_log("b")
+    store.save("a", cache["a"])
+    store.save("b", cache["b"])
+
+    assert "c" in cache
+    assert cache["c"]["messages"][0]["content"] == "stored"
+    assert list(cache.loaded) == ["a", "b", "c"]
+
+
+def test_least_recently_used_clean_conversation_is_evicted(tmp_path):
+    store = JournalConversationStore(str(tmp_path))
+    store.write_pending({conversation_id: [{"op": "snapshot", "log": make_log(conversation_id)}] for conversation_id in "abc"})
+    evicted = []
+    cache = ConversationCache(store, max_loaded=2, on_evict=evicted.append)
+    cache["a"], cache["b"], cache["c"]
+
+    assert evicted == ["a"]
+    assert list(cache.loaded) == ["b", "c"]
+
+
+def test_journal_replays_appends_truncates_and_meta(tmp_path):
+    store = JournalConversationStore(str(tmp_path))
+    store.save("a", make_log("one"))
+    store.append_message("a", {"role": "assistant", "content": "two"})
+    store.append_message("a", {"role": "user", "content": "three"})
+    store.truncate_messages("a", 2)
+    store.update_meta("a", {"model": "other", "messages": []})
+    store.write_pending(store.pending)
+
+    conversation_log = JournalConversationStore(str(tmp_path)).load("a")
+    assert [message["content"] for message in conversation_log["messages"]] == ["one", "two"]
+    assert conversation_log["model"] == "other"
+
+
+def test_journal_skips_a_torn_last_line(tmp_path):
+    store = JournalConversationStore(str(tmp_path))
+    store.write_pending({"a": [{"op": "snapshot", "log": make_log("one")}, {"op": "append", "message": {"role": "user", "content": "two"}}]})
+    with open(store.journal_path("a"), "a", encoding="utf-8") as f:
+        f.write('{"op": "append", "mess')
+
+    conversation_log = JournalConversationStore(str(tmp_path)).load("a")
+    assert [message["content"] for message in conversation_log["messages"]] == ["one", "two"]
+
+
+def test_journal_is_compacted_into_a_snapshot(tmp_path):
+    store = JournalConversationStore(str(tmp_path), compact_after_records=3)
+    store.write_pending({"a": [{"op": "snapshot", "log": make_log("one")}]})
+    store.write_pending({"a": [{"op": "append", "message": {"role": "user", "content": content}} for content in ("two", "three", "four")]})
+
+    records = store.read_journal(store.journal_path("a"))
+    assert [record["op"] for record in records] == ["snapshot"]
+    assert len(store.load("a")["messages"]) == 4
+
+
+def test_close_waits_for_the_flush_in_progress(tmp_path):
+    class SlowStore(JournalConversationStore):
+        def __init__(self, log_folder):
+            super().__init__(log_folder, flush_interval=0.01)
+            self.active_writes = 0
+            self.overlapped = False
+
+        def write_pending(self, pending):
+            self.active_writes += 1
+            self.overlapped = self.overlapped or self.active_writes > 1
+            time.sleep(0.1)
+            super().write_pending(pending)
+            self.active_writes -= 1
+
+    async def scenario():
+        store = SlowStore(str(tmp_path))
+        store.start()
+        store.save("a", make_log("one"))
+        await asyncio.sleep(0.05)
+        store.append_message("a", {"role": "assistant", "content": "two"})
+        await store.close()
+        return store
+
+    store = asyncio.run(scenario())
+    assert not store.overlapped
+    assert [message["content"] for message in store.load("a")["messages"]] == ["one", "two"]
+
+
+def test_sqlite_loads_do_not_wait_for_a_flush(tmp_path):
+    store = SQLiteConversationStore(str(tmp_path / "conversations.db"))
+    store.write_pending({"a": [{"op": "snapshot", "log": make_log("one")}]})
+    # A flush thread holding the write lock does not block reads
+    with store.connection_lock:
+        assert store.exists("a")
+        assert store.load("a")["messages"][0]["content"] == "one"
+    asyncio.run(store.close())
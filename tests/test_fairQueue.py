@@ -0,0 +1,113 @@
+import asyncio
+from fairQueue import FairScheduler
+from modelBatching import ModelBatchGate
+
+
+async def run_in_admission_order(scheduler, requests):
+    """Queue (user_id, lane) requests behind a held slot and return the order they were admitted in."""
+    order = []
+
+    async def request(user_id, lane):
+        async with scheduler.slot(user_id, lane):
+            order.append((user_id, lane))
+            await asyncio.sleep(0)
+
+    await scheduler.acquire("holder", "public")
+    tasks = []
+    for user_id, lane in requests:
+        tasks.append(asyncio.create_task(request(user_id, lane)))
+        await asyncio.sleep(0)
+    scheduler.release()
+    await asyncio.gather(*tasks)
+    return order
+
+
+def test_users_take_turns_within_a_lane():
+    scheduler = FairScheduler(1)
+    order = asyncio.run(run_in_admission_order(scheduler, [(1, "public"), (1, "public"), (1, "public"), (2, "public")]))
+    assert [user_id for user_id, _ in order] == [1, 2, 1, 1]
+
+
+def test_lanes_are_served_by_weight():
+    scheduler = FairScheduler(1, {"intent": 1, "private": 2, "public": 1})
+    requests = [(1, "public")] * 3 + [(2, "private")] * 4
+    order = asyncio.run(run_in_admission_order(scheduler, requests))
+    assert [lane for _, lane in order] == ["private", "public", "private", "private", "public", "private", "public"]
+
+
+def test_cancel_while_waiting_does_not_leak_the_slot():
+    async def scenario():
+        scheduler = FairScheduler(1)
+        await scheduler.acquire(1, "public")
+        waiting = asyncio.create_task(scheduler.acquire(2, "public"))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        scheduler.release()
+        try:
+            await waiting
+        except asyncio.CancelledError:
+            pass
+        assert scheduler.active == 0
+        assert not scheduler.has_waiters()
+        await asyncio.wait_for(scheduler.acquire(3, "public"), timeout=1)
+
+    asyncio.run(scenario())
+
+
+def test_position_counts_other_users_once_per_turn():
+    scheduler = FairScheduler(1)
+    assert scheduler.enqueued(1, "public") == 1
+    assert scheduler.enqueued(1, "public") == 2
+    # A new user only waits for the first request of user 1
+    assert scheduler.enqueued(2, "public") == 2
+    scheduler.dequeued(1, "public")
+    assert scheduler.pending_counts("public") == {1: 1, 2: 1}
+
+
+def test_requests_waiting_for_a_backend_slot_count_towards_the_position():
+    async def scenario():
+        scheduler = FairScheduler(4)
+        gate = ModelBatchGate("local_gpu", 1, lane_weights=scheduler.lane_weights)
+
+        async def request(user_id, admitted):
+            scheduler.enqueued(user_id, "public")
+            async with gate.slot("model", user_id, "public"), scheduler.slot(user_id, "public", queued=True):
+                scheduler.dequeued(user_id, "public")
+                admitted.set()
+                await asyncio.Event().wait()
+
+        running = asyncio.Event()
+        tasks = [asyncio.create_task(request(1, running))]
+        await running.wait()
+        tasks += [asyncio.create_task(request(user_id, asyncio.Event())) for user_id in (2, 3)]
+        await asyncio.sleep(0)
+        position = scheduler.enqueued(4, "public")
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return position
+
+    # One request runs, users 2 and 3 wait for the GPU and go first
+    assert asyncio.run(scenario()) == 3
+
+
+def test_backend_gate_lets_users_take_turns():
+    async def scenario():
+        gate = ModelBatchGate("local_gpu", 1, max_wait_seconds=30)
+        order = []
+
+        async def request(user_id):
+            async with gate.slot("model", user_id, "public"):
+                order.append(user_id)
+                await asyncio.sleep(0)
+
+        await gate.acquire("model")
+        tasks = []
+        for user_id in (1, 1, 1, 2, 3):
+            tasks.append(asyncio.create_task(request(user_id)))
+            await asyncio.sleep(0)
+        gate.release("model")
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(scenario()) == [1, 2, 3, 1, 1]
@@ -0,0 +1,43 @@
+import asyncio
+from modelBatching import ModelBatchGate
+
+
+def test_batches_requests_for_the_running_model():
+    async def scenario():
+        gate = ModelBatchGate("test", capacity=1, max_wait_seconds=30)
+        order = []
+
+        async def request(model_key):
+            async with gate.slot(model_key):
+                order.append(model_key)
+                await asyncio.sleep(0)
+
+        await asyncio.gather(*(request(model_key) for model_key in "ABABABAB"))
+        return gate, order
+
+    gate, order = asyncio.run(scenario())
+    assert "".join(order) == "AAAABBBB"
+    assert gate.switches == 1
+    assert gate.stats()["running"] == {}
+
+
+def test_cancel_while_waiting_does_not_wedge_the_gate():
+    async def scenario():
+        gate = ModelBatchGate("test", capacity=1)
+        await gate.acquire("A")
+        waiting = asyncio.create_task(gate.acquire("B"))
+        await asyncio.sleep(0)
+        # Cancelled, and the holder releases before the cancelled task gets to run
+        waiting.cancel()
+        gate.release("A")
+        try:
+            await waiting
+        except asyncio.CancelledError:
+            pass
+        assert gate.running == {}
+        assert gate.waiters == []
+
+        await asyncio.wait_for(gate.acquire("C"), timeout=1)
+        assert gate.running == {"C": 1}
+
+    asyncio.run(scenario())
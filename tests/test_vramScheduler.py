@@ -0,0 +1,74 @@
+import asyncio
+from vramScheduler import VramScheduler
+
+
+class FakeBackend():
+    def __init__(self):
+        self.unloaded = []
+
+    async def unload_model(self, model_key):
+        self.unloaded.append(model_key)
+
+
+def test_least_recently_used_idle_model_is_evicted():
+    async def scenario():
+        backend = FakeBackend()
+        scheduler = VramScheduler(10, backend.unload_model)
+        async with scheduler.use("a", 4):
+            pass
+        async with scheduler.use("b", 4):
+            pass
+        async with scheduler.use("a", 4):
+            pass
+        async with scheduler.use("c", 4):
+            pass
+        return scheduler, backend
+
+    scheduler, backend = asyncio.run(scenario())
+    assert backend.unloaded == ["b"]
+    assert [model["model"] for model in scheduler.state()["models"]] == ["a", "c"]
+
+
+def test_models_in_use_are_not_evicted_and_requests_wait():
+    async def scenario():
+        backend = FakeBackend()
+        scheduler = VramScheduler(10, backend.unload_model)
+        await scheduler.acquire("a", 6)
+        waiting = asyncio.create_task(scheduler.acquire("b", 6))
+        await asyncio.sleep(0.01)
+        assert not waiting.done()
+        assert backend.unloaded == []
+
+        await scheduler.release("a")
+        await asyncio.wait_for(waiting, timeout=1)
+        assert backend.unloaded == ["a"]
+        assert scheduler.used_gb() == 6
+
+    asyncio.run(scenario())
+
+
+def test_model_larger_than_the_budget_is_rejected():
+    async def scenario():
+        scheduler = VramScheduler(10, FakeBackend().unload_model)
+        try:
+            await scheduler.acquire("huge", 12)
+        except MemoryError:
+            return True
+        return False
+
+    assert asyncio.run(scenario())
+
+
+def test_unload_all_keeps_models_in_use():
+    async def scenario():
+        backend = FakeBackend()
+        scheduler = VramScheduler(10, backend.unload_model)
+        async with scheduler.use("a", 2):
+            pass
+        await scheduler.acquire("b", 2)
+        await scheduler.unload_all()
+        return scheduler, backend
+
+    scheduler, backend = asyncio.run(scenario())
+    assert backend.unloaded == ["a"]
+    assert scheduler.used_gb() == 2